@@ -0,0 +1,300 @@
+import argparse
+import copy
+import time
+import random
+import tracemalloc
+from typing import Any, Callable
+
+import torch
+from text_utils.inference import Beam
+
+from deep_sparql.api.generator import DecodingState, select_beam_candidates
+from deep_sparql.constraints import MaskBuffer, scatter_continuations
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+
+    state = benchmarks.add_parser(
+        "state",
+        help="benchmark forking decoding states during beam search"
+    )
+    state.add_argument(
+        "--beam-widths",
+        type=int,
+        nargs="+",
+        default=[4, 8, 16]
+    )
+    state.add_argument("--prompt-length", type=int, default=512)
+    state.add_argument("--steps", type=int, default=32)
+
+    masking = benchmarks.add_parser(
+        "masking",
+        help="benchmark building and applying continuation masks"
+    )
+    masking.add_argument(
+        "--batch-sizes",
+        type=int,
+        nargs="+",
+        default=[8, 32, 64]
+    )
+    masking.add_argument("--vocab-size", type=int, default=32_000)
+    masking.add_argument(
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    masking.add_argument("--steps", type=int, default=100)
+    masking.add_argument(
+        "--dense-fraction",
+        type=float,
+        default=0.25,
+        help="Fraction of rows with a dense mask, all other rows "
+        "only allow a few tokens"
+    )
+    masking.add_argument("--num-allowed", type=int, default=16)
+
+    beam = benchmarks.add_parser(
+        "beam",
+        help="benchmark selecting beam candidates"
+    )
+    beam.add_argument(
+        "--beam-widths",
+        type=int,
+        nargs="+",
+        default=[5, 10, 20]
+    )
+    beam.add_argument("--batch-size", type=int, default=8)
+    beam.add_argument("--vocab-size", type=int, default=32_000)
+    beam.add_argument("--length", type=int, default=64)
+    beam.add_argument(
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    beam.add_argument("--steps", type=int, default=100)
+    return parser.parse_args()
+
+
+def _measure(fn: Callable[[], Any]) -> tuple[float, int]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn()
+    end = time.perf_counter()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return end - start, peak
+
+
+def benchmark_state(args: argparse.Namespace):
+    # every step, each of the beam_width beams is forked into
+    # beam_width candidates, of which the best 2 * beam_width
+    # are kept, same as in SPARQLGenerator._beam_select_fn
+    prompt = list(range(args.prompt_length))
+
+    def _fork_states(beam_width: int):
+        state = DecodingState(prompt, [-1], [-2], [-3], [-4], None, None, [])
+        beams = [state]
+        for step in range(args.steps):
+            candidates = []
+            for beam in beams:
+                for _ in range(2 * beam_width):
+                    candidate = copy.deepcopy({"state": beam})["state"]
+                    candidate.add(step, None)
+                    candidates.append(candidate)
+            beams = candidates[:beam_width]
+
+    def _fork_lists(beam_width: int):
+        # the previous representation, copying the full token
+        # list and decoding history for every candidate
+        beams = [{"token_ids": list(prompt), "decoded": []}]
+        for step in range(args.steps):
+            candidates = []
+            for beam in beams:
+                for _ in range(2 * beam_width):
+                    candidate = copy.deepcopy(beam)
+                    candidate["token_ids"].append(step)
+                    candidates.append(candidate)
+            beams = candidates[:beam_width]
+
+    print(
+        f"prompt length {args.prompt_length:,}, "
+        f"{args.steps:,} decoding steps"
+    )
+    for beam_width in args.beam_widths:
+        list_time, list_mem = _measure(lambda: _fork_lists(beam_width))
+        state_time, state_mem = _measure(lambda: _fork_states(beam_width))
+        print(
+            f"beam width {beam_width:>3}: "
+            f"list copy {1000 * list_time:.1f}ms "
+            f"({list_mem / 1024:.0f}KiB peak) | "
+            f"shared state {1000 * state_time:.1f}ms "
+            f"({state_mem / 1024:.0f}KiB peak) | "
+            f"{list_time / state_time:.1f}x faster"
+        )
+
+
+def benchmark_masking(args: argparse.Namespace):
+    device = torch.device(args.device)
+    rand = random.Random(22)
+
+    def _sync():
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    def _rows(batch_size: int) -> tuple[list, list, list, list]:
+        dense_rows = []
+        dense_masks = []
+        sparse_rows = []
+        sparse_token_ids = []
+        for i in range(batch_size):
+            if rand.random() < args.dense_fraction:
+                dense_rows.append(i)
+                dense_masks.append(torch.rand(args.vocab_size) < 0.5)
+            else:
+                sparse_rows.append(i)
+                sparse_token_ids.append(rand.sample(
+                    range(args.vocab_size),
+                    args.num_allowed
+                ))
+        return dense_rows, dense_masks, sparse_rows, sparse_token_ids
+
+    def _cpu(scores: torch.Tensor, rows: tuple):
+        # the previous approach, building the mask on the cpu
+        # and indexing the scores with it
+        mask = torch.ones(*scores.shape, dtype=torch.bool)
+        scatter_continuations(mask, *rows)
+        scores[torch.logical_not(mask)] = float("-inf")
+        return torch.argmax(scores, -1)
+
+    buffer = MaskBuffer()
+
+    def _device(scores: torch.Tensor, rows: tuple):
+        mask = buffer.get(*scores.shape, scores.device)
+        scatter_continuations(mask, *rows)
+        scores.masked_fill_(torch.logical_not(mask), float("-inf"))
+        return torch.argmax(scores, -1)
+
+    print(f"vocab size {args.vocab_size:,} on {device}")
+    for batch_size in args.batch_sizes:
+        rows = [_rows(batch_size) for _ in range(args.steps)]
+        scores = torch.randn(batch_size, args.vocab_size, device=device)
+        times = []
+        for fn in [_cpu, _device]:
+            # warmup
+            fn(scores.clone(), rows[0])
+            _sync()
+            start = time.perf_counter()
+            for step_rows in rows:
+                fn(scores.clone(), step_rows)
+            _sync()
+            times.append((time.perf_counter() - start) / args.steps)
+        cpu_time, device_time = times
+        print(
+            f"batch size {batch_size:>3}: "
+            f"cpu mask {1000 * cpu_time:.2f}ms/step | "
+            f"device mask {1000 * device_time:.2f}ms/step | "
+            f"{cpu_time / device_time:.1f}x faster"
+        )
+
+
+def benchmark_beam(args: argparse.Namespace):
+    device = torch.device(args.device)
+
+    def _select_python(
+        scores: torch.Tensor,
+        batch_beams: list[list[Beam]],
+        beam_width: int
+    ) -> list[list[Beam]]:
+        # the previous approach, building, sorting and
+        # converting all candidates in python
+        k = min(beam_width, scores.shape[1])
+        top_k = torch.topk(scores, k, dim=1)
+        batch_start = 0
+        batch_candidates = []
+        for beams in batch_beams:
+            num = len(beams)
+            indices = top_k.indices[batch_start:batch_start + num]
+            log_probs = top_k.values[batch_start:batch_start + num]
+            batch_start += num
+            candidates = []
+            for idx, (token_ids, lps) in enumerate(zip(
+                indices.tolist(),
+                log_probs.tolist()
+            )):
+                for token_id, log_p in zip(token_ids, lps):
+                    candidates.append((idx, token_id, log_p))
+            candidates = sorted(
+                candidates,
+                key=lambda item: -(beams[item[0]].log_prob + item[2]),
+            )[:2 * beam_width]
+            batch_candidates.append([
+                Beam.from_beam(beams[idx], log_p, token_id)
+                for idx, token_id, log_p in candidates
+            ])
+        return batch_candidates
+
+    def _select_tensor(
+        scores: torch.Tensor,
+        batch_beams: list[list[Beam]],
+        beam_width: int
+    ) -> list[list[Beam]]:
+        selected = select_beam_candidates(
+            scores,
+            [beam.log_prob for beams in batch_beams for beam in beams],
+            [len(beams) for beams in batch_beams],
+            beam_width
+        )
+        return [
+            [
+                Beam.from_beam(beams[idx], log_p, token_id)
+                for idx, token_id, log_p in candidates
+            ]
+            for beams, candidates in zip(batch_beams, selected)
+        ]
+
+    print(
+        f"batch size {args.batch_size}, vocab size {args.vocab_size:,} "
+        f"on {device}"
+    )
+    for beam_width in args.beam_widths:
+        batch_beams = [
+            [
+                Beam(
+                    list(range(args.length)),
+                    torch.rand(args.length).log().tolist()
+                )
+                for _ in range(beam_width)
+            ]
+            for _ in range(args.batch_size)
+        ]
+        scores = torch.log_softmax(torch.randn(
+            args.batch_size * beam_width,
+            args.vocab_size,
+            device=device
+        ), dim=-1)
+        times = []
+        for fn in [_select_python, _select_tensor]:
+            fn(scores, batch_beams, beam_width)
+            start = time.perf_counter()
+            for _ in range(args.steps):
+                fn(scores, batch_beams, beam_width)
+            times.append((time.perf_counter() - start) / args.steps)
+        python_time, tensor_time = times
+        print(
+            f"beam width {beam_width:>3}: "
+            f"python {1000 * python_time:.2f}ms/step | "
+            f"tensor {1000 * tensor_time:.2f}ms/step | "
+            f"{python_time / tensor_time:.1f}x faster"
+        )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.benchmark == "state":
+        benchmark_state(args)
+    elif args.benchmark == "masking":
+        benchmark_masking(args)
+    elif args.benchmark == "beam":
+        benchmark_beam(args)
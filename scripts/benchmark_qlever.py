@@ -0,0 +1,312 @@
+import argparse
+import json
+import threading
+import time
+import tracemalloc
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Pool
+from typing import Any, Callable
+
+from deep_sparql.utils import (
+    QLeverClient,
+    calc_f1_from_fingerprints,
+    calc_f1_from_sets,
+    query_entities,
+    query_entities_iter,
+    query_fingerprints,
+    query_qlever
+)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+
+    results = benchmarks.add_parser(
+        "results",
+        help="benchmark querying and parsing large results from a local "
+        "stub server in different formats"
+    )
+    results.add_argument(
+        "--num-rows",
+        type=int,
+        nargs="+",
+        default=[10_000, 100_000, 500_000]
+    )
+    results.add_argument("--num-vars", type=int, default=2)
+    results.add_argument("--repeat", type=int, default=3)
+    results.add_argument(
+        "--max-rows",
+        type=int,
+        default=8193,
+        help="Row limit for the early terminating variants"
+    )
+
+    evaluation = benchmarks.add_parser(
+        "evaluation",
+        help="benchmark executing evaluation queries against a local "
+        "stub server with simulated latency"
+    )
+    evaluation.add_argument("--num-queries", type=int, default=500)
+    evaluation.add_argument("--num-rows", type=int, default=100)
+    evaluation.add_argument(
+        "--latency",
+        type=float,
+        default=0.05,
+        help="Simulated server latency per query in seconds"
+    )
+    evaluation.add_argument(
+        "--concurrency",
+        type=int,
+        nargs="+",
+        default=[4, 16, 64]
+    )
+
+    f1 = benchmarks.add_parser(
+        "f1",
+        help="benchmark computing the f1 score between large results "
+        "from a local stub server"
+    )
+    f1.add_argument(
+        "--num-rows",
+        type=int,
+        nargs="+",
+        default=[100_000, 1_000_000]
+    )
+    f1.add_argument("--num-vars", type=int, default=2)
+    f1.add_argument("--repeat", type=int, default=1)
+    return parser.parse_args()
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, *_: Any):
+        # clients closing connections early is expected
+        pass
+
+
+class StubServer:
+    # serves the same synthetic result in sparql json or tsv format,
+    # depending on the accept header of the request, optionally after
+    # a simulated latency
+    def __init__(self, num_rows: int, num_vars: int, latency: float = 0.0):
+        self.vars = [f"x{i}" for i in range(num_vars)]
+        self.json = self._json(num_rows).encode("utf8")
+        self.tsv = self._tsv(num_rows).encode("utf8")
+
+        stub = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *_: Any):
+                pass
+
+            def do_GET(self):
+                time.sleep(latency)
+                if "tab-separated-values" in self.headers.get("Accept", ""):
+                    body = stub.tsv
+                    content_type = "text/tab-separated-values"
+                else:
+                    body = stub.json
+                    content_type = "application/sparql-results+json"
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                try:
+                    for i in range(0, len(body), 2 ** 16):
+                        self.wfile.write(body[i:i + 2 ** 16])
+                except (BrokenPipeError, ConnectionResetError):
+                    # client stopped reading early
+                    pass
+
+        self.server = _Server(("127.0.0.1", 0), _Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def _value(self, row: int, col: int) -> str:
+        if col % 2 == 0:
+            return f"http://www.wikidata.org/entity/Q{row}"
+        return f"label {row}"
+
+    def _json(self, num_rows: int) -> str:
+        bindings = [
+            {
+                var: {
+                    "type": "uri" if i % 2 == 0 else "literal",
+                    "value": self._value(row, i)
+                }
+                for i, var in enumerate(self.vars)
+            }
+            for row in range(num_rows)
+        ]
+        return json.dumps({
+            "head": {"vars": self.vars},
+            "results": {"bindings": bindings}
+        })
+
+    def _tsv(self, num_rows: int) -> str:
+        lines = ["\t".join(f"?{var}" for var in self.vars)]
+        for row in range(num_rows):
+            lines.append("\t".join(
+                f"<{self._value(row, i)}>" if i % 2 == 0
+                else f"\"{self._value(row, i)}\"@en"
+                for i in range(len(self.vars))
+            ))
+        return "\n".join(lines) + "\n"
+
+    def __enter__(self) -> "StubServer":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *_: Any):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _measure(fn: Callable[[], Any], repeat: int) -> tuple[float, int]:
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    runtime = (time.perf_counter() - start) / repeat
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return runtime, peak
+
+
+def benchmark_results(args: argparse.Namespace):
+    client = QLeverClient()
+    variants: list[tuple[str, dict[str, Any]]] = [
+        ("json", {}),
+        ("json stream", {"stream": True}),
+        ("tsv stream", {"stream": True, "result_format": "tsv"}),
+        (
+            f"json stream, {args.max_rows:,} rows",
+            {"stream": True, "max_rows": args.max_rows}
+        ),
+        (
+            f"tsv stream, {args.max_rows:,} rows",
+            {"stream": True, "max_rows": args.max_rows, "result_format": "tsv"}
+        ),
+    ]
+    for num_rows in args.num_rows:
+        with StubServer(num_rows, args.num_vars) as stub:
+            print(
+                f"{num_rows:,} rows, {args.num_vars} variables "
+                f"({len(stub.json) / 1024 ** 2:.1f}MiB json, "
+                f"{len(stub.tsv) / 1024 ** 2:.1f}MiB tsv)"
+            )
+            base = None
+            for name, kwargs in variants:
+                runtime, peak = _measure(
+                    lambda: query_qlever(
+                        "SELECT * WHERE { ?s ?p ?o }",
+                        qlever_endpoint=stub.url,
+                        client=client,
+                        **kwargs
+                    ),
+                    args.repeat
+                )
+                base = base or runtime
+                print(
+                    f"  {name:<28}: {1000 * runtime:>8.1f}ms "
+                    f"({peak / 1024 ** 2:>6.1f}MiB peak) | "
+                    f"{base / runtime:.1f}x"
+                )
+
+
+def benchmark_evaluation(args: argparse.Namespace):
+    queries = [
+        f"SELECT ?x WHERE {{ ?x ?p {i} }}"
+        for i in range(args.num_queries)
+    ]
+    print(
+        f"{args.num_queries:,} queries, {args.num_rows:,} rows each, "
+        f"{1000 * args.latency:.0f}ms latency"
+    )
+    with StubServer(args.num_rows, 1, args.latency) as stub:
+        for concurrency in args.concurrency:
+            # the previous approach, one process per concurrent query
+            start = time.perf_counter()
+            with Pool(concurrency) as pool:
+                process_results = pool.map(
+                    partial(query_entities, qlever_endpoint=stub.url),
+                    queries,
+                    chunksize=16
+                )
+            process_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            client = QLeverClient(max_concurrent=concurrency)
+            thread_results = list(query_entities_iter(
+                ((query, False) for query in queries),
+                qlever_endpoint=stub.url,
+                client=client,
+                max_workers=concurrency
+            ))
+            client.close()
+            thread_time = time.perf_counter() - start
+            assert process_results == thread_results
+
+            print(
+                f"concurrency {concurrency:>3}: "
+                f"processes {args.num_queries / process_time:>7.1f} q/s | "
+                f"threads {args.num_queries / thread_time:>7.1f} q/s | "
+                f"{process_time / thread_time:.1f}x faster"
+            )
+
+
+def benchmark_f1(args: argparse.Namespace):
+    client = QLeverClient()
+    query = "SELECT * WHERE { ?s ?p ?o }"
+
+    def _sets() -> float | None:
+        pred = query_entities(query, qlever_endpoint=stub.url, client=client)
+        target = query_entities(
+            query,
+            qlever_endpoint=stub.url,
+            client=client
+        )
+        return calc_f1_from_sets(pred, target)[0]
+
+    def _fingerprints() -> float | None:
+        pred = query_fingerprints(
+            query,
+            qlever_endpoint=stub.url,
+            client=client
+        )
+        target = query_fingerprints(
+            query,
+            qlever_endpoint=stub.url,
+            client=client
+        )
+        return calc_f1_from_fingerprints(pred, target)[0]
+
+    for num_rows in args.num_rows:
+        with StubServer(num_rows, args.num_vars) as stub:
+            print(f"{num_rows:,} rows, {args.num_vars} variables")
+            assert _sets() == _fingerprints() == 1.0
+            set_time, set_peak = _measure(_sets, args.repeat)
+            fp_time, fp_peak = _measure(_fingerprints, args.repeat)
+            print(
+                f"  sets {1000 * set_time:.0f}ms "
+                f"({set_peak / 1024 ** 2:.1f}MiB peak) | "
+                f"fingerprints {1000 * fp_time:.0f}ms "
+                f"({fp_peak / 1024 ** 2:.1f}MiB peak) | "
+                f"{set_peak / fp_peak:.1f}x less memory"
+            )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.benchmark == "results":
+        benchmark_results(args)
+    elif args.benchmark == "evaluation":
+        benchmark_evaluation(args)
+    elif args.benchmark == "f1":
+        benchmark_f1(args)
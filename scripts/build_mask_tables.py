@@ -0,0 +1,57 @@
+import argparse
+import time
+
+from text_utils import prefix, tokenization
+from text_utils.configuration import load_config
+
+from deep_sparql.constraints import MaskTable, compute_continuations
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i",
+        "--index",
+        type=str,
+        nargs="+",
+        required=True,
+        help="Prefix index files, mask tables are saved next to them"
+    )
+    parser.add_argument(
+        "-t",
+        "--tokenizer-cfg",
+        type=str,
+        required=True,
+        help="Output tokenizer config of the models using the indices"
+    )
+    parser.add_argument(
+        "-d",
+        "--max-depth",
+        type=int,
+        default=1,
+        help="Precompute masks for all prefixes up to this many tokens"
+    )
+    return parser.parse_args()
+
+
+def build(args: argparse.Namespace):
+    cfg = load_config(args.tokenizer_cfg)
+    tokenizer = tokenization.Tokenizer.from_config(cfg)
+    continuations = compute_continuations(tokenizer, cfg["eos_token"])
+
+    for path in args.index:
+        start = time.perf_counter()
+        index = prefix.Vec.load(path)
+        index.set_continuations(continuations, max_depth=1)
+        table = MaskTable.build(index, continuations, args.max_depth)
+        table.save(f"{path}.masks")
+        end = time.perf_counter()
+        print(
+            f"built mask table with {len(table.values):,} prefixes "
+            f"({table.masks.nbytes / 1024 ** 2:.1f}MiB) for {path} "
+            f"in {end - start:.1f}s"
+        )
+
+
+if __name__ == "__main__":
+    build(parse_args())
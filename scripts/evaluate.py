@@ -1,7 +1,9 @@
 import argparse
+import hashlib
+import json
 import os
-from typing import Optional, Tuple
-from multiprocessing import Pool
+from collections import Counter
+from typing import Any, Optional, Set, Tuple
 
 from tqdm import tqdm
 
@@ -10,7 +12,13 @@ from text_utils.io import load_text_file
 
 from deep_sparql.utils import (
     KNOWLEDGE_GRAPHS,
-    calc_f1
+    QLeverClient,
+    QueryResultCache,
+    RowFingerprints,
+    calc_f1_from_fingerprints,
+    calc_f1_from_sets,
+    canonicalize_sparql,
+    query_entities_iter
 )
 
 
@@ -21,8 +29,44 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--prediction", type=str, required=True)
     parser.add_argument("--save-invalid", type=str, default=None)
     parser.add_argument("--save-incorrect", type=str, default=None)
-    parser.add_argument("-n", "--num-processes", type=int, default=4)
+    parser.add_argument(
+        "--results-file",
+        type=str,
+        default=None,
+        help="JSONL file to stream per item results to as they complete; "
+        "if it exists, items already in it are skipped and the final "
+        "scores are computed over all of its items; resuming from a file "
+        "written for other inputs or options fails"
+    )
+    parser.add_argument(
+        "-n",
+        "--concurrency",
+        "--num-processes",
+        dest="concurrency",
+        type=int,
+        default=16,
+        help="Maximum number of queries executed concurrently"
+    )
+    parser.add_argument(
+        "--max-requests-per-second",
+        type=float,
+        default=None,
+        help="Limit the rate of requests sent to the endpoint"
+    )
     parser.add_argument("--allow-subset", action="store_true")
+    parser.add_argument(
+        "--fingerprints",
+        action="store_true",
+        help="Compare 64 bit fingerprints of result rows instead of "
+        "the rows themselves, needs much less memory for large results"
+    )
+    parser.add_argument(
+        "--max-rows",
+        type=int,
+        default=None,
+        help="Read at most this many rows per query result, larger "
+        "results are counted as truncated (requires --fingerprints)"
+    )
     parser.add_argument("--empty-target-invalid", action="store_true")
     parser.add_argument(
         "--kg",
@@ -31,15 +75,21 @@ def parse_args() -> argparse.Namespace:
         default="wikidata"
     )
     parser.add_argument("--qlever-endpoint", type=str, default=None)
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Directory to cache target query results in across evaluations"
+    )
+    parser.add_argument(
+        "--invalidate-cache",
+        action="store_true",
+        help="Remove all cached target results for the given kg and "
+        "endpoint before evaluating"
+    )
     return parser.parse_args()
 
 
-def calc_f1_map(
-    args: Tuple[str, str, bool, str, str | None]
-) -> Tuple[Optional[float], bool, bool]:
-    return calc_f1(*args)
-
-
 def delete_file_or_create_dir(path: str):
     if os.path.exists(path):
         os.remove(path)
@@ -49,12 +99,81 @@ def delete_file_or_create_dir(path: str):
             os.makedirs(dirname, exist_ok=True)
 
 
+def results_header(
+    args: argparse.Namespace,
+    pairs: list[Tuple[str, str]]
+) -> dict[str, Any]:
+    # everything the per item results depend on, such that
+    # results of other inputs or options are never resumed from
+    h = hashlib.sha256()
+    for pred, target in pairs:
+        h.update(f"{pred}\n{target}\n".encode("utf8"))
+    return {
+        "inputs": h.hexdigest(),
+        "kg": args.kg,
+        "qlever_endpoint": args.qlever_endpoint,
+        "fingerprints": args.fingerprints,
+        "max_rows": args.max_rows,
+        "empty_target_invalid": args.empty_target_invalid
+    }
+
+
+def load_records(
+    path: str,
+    header: dict[str, Any]
+) -> dict[int, dict[str, Any]]:
+    # the first line of the file is its header, an incomplete last
+    # line, e.g. from a crash while writing, is dropped and the file
+    # rewritten without it
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, "r", encoding="utf8") as inf:
+        lines = inf.readlines()
+    if len(lines) == 0:
+        return records
+    try:
+        file_header = json.loads(lines[0]).get("header")
+    except json.JSONDecodeError:
+        file_header = None
+    if file_header is None and len(lines) == 1:
+        # crashed while writing the header
+        return records
+    if file_header != header:
+        raise RuntimeError(
+            f"results file {path} was written for different inputs or "
+            "options, remove it or use another results file"
+        )
+    valid = True
+    for line in lines[1:]:
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            valid = False
+            continue
+        records[record["index"]] = record
+    if not valid:
+        with open(path, "w", encoding="utf8") as of:
+            of.write(json.dumps({"header": header}) + "\n")
+            for record in records.values():
+                of.write(json.dumps(record) + "\n")
+    return records
+
+
+def num_rows(
+    result: Optional[Set[Tuple[str, ...]] | RowFingerprints]
+) -> int | None:
+    return None if result is None else len(result)
+
+
 def evaluate(args: argparse.Namespace):
     targets = load_text_file(args.target)
     predictions = load_text_file(args.prediction)
     if not args.allow_subset:
         assert len(targets) == len(predictions), \
             "expected same number of predictions and targets"
+    assert args.fingerprints or args.max_rows is None, \
+        "--max-rows requires --fingerprints"
 
     if args.save_invalid or args.save_incorrect:
         inputs = load_text_file(args.input)
@@ -69,50 +188,161 @@ def evaluate(args: argparse.Namespace):
     if args.save_incorrect:
         delete_file_or_create_dir(args.save_incorrect)
 
+    pairs = list(zip(predictions, targets))
+    records: dict[int, dict[str, Any]] = {}
+    if args.results_file is not None:
+        header = results_header(args, pairs)
+        records = load_records(args.results_file, header)
+        assert all(i < len(pairs) for i in records), \
+            "results file contains more items than given"
+        if len(records) > 0:
+            print(f"Resuming with {len(records):,} finished items")
+        else:
+            delete_file_or_create_dir(args.results_file)
+            with open(args.results_file, "w", encoding="utf8") as of:
+                of.write(json.dumps({"header": header}) + "\n")
+
+    cache = None
+    if args.cache_dir is not None:
+        os.makedirs(args.cache_dir, exist_ok=True)
+        cache = QueryResultCache(
+            os.path.join(args.cache_dir, "targets.sqlite")
+        )
+        if args.invalidate_cache:
+            deleted = cache.invalidate(args.kg, args.qlever_endpoint)
+            print(f"Removed {deleted:,} cached target results")
+
+    # execute every distinct query of the unfinished items only
+    # once, queries used as a target are looked up in the target cache
+    todo = [i for i in range(len(pairs)) if i not in records]
+    keys = {
+        i: (canonicalize_sparql(pairs[i][0]), canonicalize_sparql(pairs[i][1]))
+        for i in todo
+    }
+    queries: dict[str, Tuple[str, bool]] = {}
+    for i in todo:
+        pred, target = pairs[i]
+        pred_key, target_key = keys[i]
+        queries.setdefault(pred_key, (pred, False))
+        sparql, _ = queries.get(target_key, (target, True))
+        queries[target_key] = (sparql, True)
+
+    # queries finish in order, so an item is ready once the
+    # later of its two queries finished; results are kept only
+    # until the last item using them is done
+    positions = {key: pos for pos, key in enumerate(queries)}
+    ready: dict[int, list[int]] = {}
+    remaining: Counter[str] = Counter()
+    for i in todo:
+        pos = max(positions[key] for key in keys[i])
+        ready.setdefault(pos, []).append(i)
+        remaining.update(keys[i])
+
+    calc_f1 = calc_f1_from_sets
+    if args.fingerprints:
+        calc_f1 = calc_f1_from_fingerprints
+
+    # queries are io bound, so they are executed in threads sharing
+    # one connection pool and cache instead of in separate processes
+    client = QLeverClient(
+        max_concurrent=args.concurrency,
+        max_requests_per_second=args.max_requests_per_second
+    )
+    results: dict[
+        str,
+        Tuple[Optional[Set[Tuple[str, ...]] | RowFingerprints], float]
+    ] = {}
+    results_file = None
+    if args.results_file is not None:
+        results_file = open(args.results_file, "a", encoding="utf8")
+    for pos, (query, result) in enumerate(zip(queries, tqdm(
+        query_entities_iter(
+            queries.values(),
+            args.kg,
+            args.qlever_endpoint,
+            client,
+            cache,
+            max_workers=args.concurrency,
+            fingerprints=args.fingerprints,
+            max_rows=args.max_rows,
+            timed=True
+        ),
+        desc="executing queries",
+        total=len(queries),
+        leave=False
+    ))):
+        results[query] = result
+        for i in ready.pop(pos, []):
+            pred_key, target_key = keys[i]
+            pred, pred_latency = results[pred_key]
+            target, target_latency = results[target_key]
+            f1, pred_inv, tgt_inv = calc_f1(
+                pred,
+                target,
+                not args.empty_target_invalid
+            )
+            record = {
+                "index": i,
+                "f1": f1,
+                "pred_invalid": pred_inv,
+                "target_invalid": tgt_inv,
+                "pred_rows": num_rows(pred),
+                "target_rows": num_rows(target),
+                "pred_latency": pred_latency,
+                "target_latency": target_latency,
+                # f1 is only computed on the first max rows
+                "truncated": any(
+                    isinstance(res, RowFingerprints) and res.truncated
+                    for res in [pred, target]
+                )
+            }
+            records[i] = record
+            if results_file is not None:
+                results_file.write(json.dumps(record) + "\n")
+                results_file.flush()
+            for key in keys[i]:
+                remaining[key] -= 1
+                if remaining[key] == 0:
+                    del results[key]
+    client.close()
+    if cache is not None:
+        cache.close()
+    if results_file is not None:
+        results_file.close()
+
     f1s = []
     pred_invalid = 0
     tgt_invalid = 0
-    with Pool(args.num_processes) as pool:
-        for i, (f1, pred_inv, tgt_inv) in tqdm(
-            enumerate(pool.imap(
-                calc_f1_map,
-                zip(
-                    predictions,
-                    targets,
-                    len(targets) * [not args.empty_target_invalid],
-                    len(targets) * [args.kg],
-                    len(targets) * [args.qlever_endpoint]
-                ),
-                chunksize=16
-            )),
-            desc="evaluating simple questions",
-            total=len(predictions),
-            leave=False
-        ):
-            if args.save_invalid and f1 is None:
-                with open(args.save_invalid, "a", encoding="utf8") as f:
-                    f.write(
-                        f"{i+1}.\n"
-                        f"input : {inputs[i]}\n"
-                        f"pred  : {predictions[i]}\n"
-                        f"target: {targets[i]}\n\n"
-                    )
-            if args.save_incorrect and f1 is not None and f1 < 1.0:
-                with open(args.save_incorrect, "a", encoding="utf8") as f:
-                    f.write(
-                        f"{i+1}.\n"
-                        f"input : {inputs[i]}\n"
-                        f"pred  : {predictions[i]}\n"
-                        f"target: {targets[i]}\n\n"
-                    )
-
-            if pred_inv:
-                pred_invalid += 1
-                f1 = 0.0
-            if tgt_inv:
-                tgt_invalid += 1
-                f1 = 0.0
-            f1s.append(f1)
+    truncated = 0
+    for i in sorted(records):
+        record = records[i]
+        f1 = record["f1"]
+        if record["truncated"]:
+            truncated += 1
+        if args.save_invalid and f1 is None:
+            with open(args.save_invalid, "a", encoding="utf8") as f:
+                f.write(
+                    f"{i+1}.\n"
+                    f"input : {inputs[i]}\n"
+                    f"pred  : {predictions[i]}\n"
+                    f"target: {targets[i]}\n\n"
+                )
+        if args.save_incorrect and f1 is not None and f1 < 1.0:
+            with open(args.save_incorrect, "a", encoding="utf8") as f:
+                f.write(
+                    f"{i+1}.\n"
+                    f"input : {inputs[i]}\n"
+                    f"pred  : {predictions[i]}\n"
+                    f"target: {targets[i]}\n\n"
+                )
+
+        if record["pred_invalid"]:
+            pred_invalid += 1
+            f1 = 0.0
+        if record["target_invalid"]:
+            tgt_invalid += 1
+            f1 = 0.0
+        f1s.append(f1)
     print(
         f"Query-averaged F1: {sum(f1s) / len(f1s):.2%} "
         f"({pred_invalid:,} invalid predictions, "
@@ -120,6 +350,16 @@ def evaluate(args: argparse.Namespace):
         f"{tgt_invalid:,} invalid targets, "
         f"{tgt_invalid / len(f1s):.2%})"
     )
+    if args.max_rows is not None:
+        print(
+            f"F1 of {truncated:,} pairs ({truncated / len(f1s):.2%}) "
+            f"computed on results truncated to {args.max_rows:,} rows"
+        )
+    num_queries = 2 * len(todo)
+    print(
+        f"Executed {len(queries):,} distinct of {num_queries:,} queries "
+        f"({num_queries - len(queries):,} executions saved)"
+    )
 
 
 if __name__ == "__main__":
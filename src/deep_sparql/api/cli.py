@@ -15,6 +15,10 @@ from deep_sparql.utils import (
     format_sparql,
     format_qlever_result,
     add_labels,
+    CompletionCache,
+    QLeverClient,
+    set_completion_cache,
+    set_qlever_client,
     _qlever_ask_to_select_post_fn
 )
 
@@ -73,8 +77,20 @@ class SPARQLCli(TextProcessingCli):
             kg=self.args.kg,
             lang=self.args.lang or "en",
             max_length=self.args.max_length,
-            use_cache=not self.args.no_kv_cache
+            use_cache=not self.args.no_kv_cache,
+            mask_cache_size=self.args.mask_cache_size,
+            completion_max_size=self.args.completion_max_size,
+            completion_time_budget=self.args.completion_time_budget
         )
+        set_qlever_client(QLeverClient(
+            read_timeout=self.args.qlever_timeout,
+            max_retries=self.args.qlever_retries
+        ))
+        if self.args.completion_cache is not None:
+            set_completion_cache(CompletionCache(
+                path=self.args.completion_cache,
+                ttl=self.args.completion_cache_ttl
+            ))
 
         index_dir = os.environ.get("SPARQL_PREFIX_INDEX", None)
         if index_dir is not None:
@@ -201,12 +217,47 @@ def main():
         action="store_true",
         help="Whether to use key and value caches during decoding"
     )
+    parser.add_argument(
+        "--mask-cache-size",
+        type=int,
+        default=128,
+        help="Number of continuation masks to cache during constrained "
+        "decoding, masks are always shared between beams within a step"
+    )
     parser.add_argument(
         "--subgraph-constraining",
         action="store_true",
         help="Whether to constrain entities and properties to already decoded "
         "subgraph, only works with entity and property indices"
     )
+    parser.add_argument(
+        "--completion-max-size",
+        type=int,
+        default=8192,
+        help="Maximum number of completions for subgraph constraining, "
+        "if there are more the full index is used"
+    )
+    parser.add_argument(
+        "--completion-time-budget",
+        type=float,
+        default=None,
+        help="Maximum number of seconds to wait for completions for subgraph "
+        "constraining, if exceeded the full index is used"
+    )
+    parser.add_argument(
+        "--completion-cache",
+        type=str,
+        default=None,
+        help="Path to a sqlite database to cache completion results for "
+        "subgraph constraining across runs"
+    )
+    parser.add_argument(
+        "--completion-cache-ttl",
+        type=float,
+        default=None,
+        help="Number of seconds after which cached completion results "
+        "are ignored"
+    )
     parser.add_argument(
         "--kg",
         choices=list(KNOWLEDGE_GRAPHS),
@@ -249,6 +300,18 @@ def main():
         default=None,
         help="URL to QLever endpoint to use for query execution"
     )
+    parser.add_argument(
+        "--qlever-timeout",
+        type=float,
+        default=120.0,
+        help="Timeout in seconds for reading QLever responses"
+    )
+    parser.add_argument(
+        "--qlever-retries",
+        type=int,
+        default=3,
+        help="Number of retries for failed QLever requests"
+    )
     execution = parser.add_mutually_exclusive_group()
     execution.add_argument(
         "--execute",
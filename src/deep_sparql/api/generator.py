@@ -1,9 +1,10 @@
 from io import TextIOWrapper
 import os
-import copy
 import sys
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Any, Dict, List, Tuple, Optional, Union, Iterator, Callable
 
+import numpy as np
 import torch
 from torch import nn
 from peft import get_peft_model
@@ -28,6 +29,17 @@ from text_utils.inference import (
 )
 
 from deep_sparql import vector
+from deep_sparql.constraints import (
+    MaskBuffer,
+    MaskCache,
+    MaskTable,
+    PrefixCursor,
+    SubIndexCache,
+    continuation_lookup,
+    continuations_fingerprint,
+    load_continuations,
+    scatter_continuations
+)
 from deep_sparql.model import (
     Model,
     PretrainedDecoder,
@@ -52,7 +64,83 @@ _NAME_TO_ZIP = {
 }
 
 
+class TokenList:
+    # persistent singly linked list of token ids, appending returns
+    # a new list that shares all previous tokens with the old one
+    __slots__ = ("token_id", "parent", "length")
+
+    def __init__(
+        self,
+        token_id: int = -1,
+        parent: "TokenList | None" = None
+    ):
+        self.token_id = token_id
+        self.parent = parent
+        self.length = 0 if parent is None else parent.length + 1
+
+    @staticmethod
+    def from_list(token_ids: list[int]) -> "TokenList":
+        tokens = TokenList()
+        for token_id in token_ids:
+            tokens = tokens.append(token_id)
+        return tokens
+
+    def append(self, token_id: int) -> "TokenList":
+        return TokenList(token_id, self)
+
+    def tail(self, n: int) -> list[int]:
+        token_ids = []
+        node = self
+        while len(token_ids) < n and node.parent is not None:
+            token_ids.append(node.token_id)
+            node = node.parent
+        return token_ids[::-1]
+
+    def endswith(self, token_ids: list[int]) -> bool:
+        return (
+            len(token_ids) <= self.length
+            and self.tail(len(token_ids)) == token_ids
+        )
+
+    def to_list(self) -> list[int]:
+        return self.tail(self.length)
+
+    def __len__(self) -> int:
+        return self.length
+
+
+def _calc_sub_index(
+    sparql: str,
+    current_state: str,
+    index: prefix.Vec,
+    entity_index: prefix.Vec,
+    property_index: prefix.Vec,
+    sub_index_cache: SubIndexCache,
+    kg: str,
+    lang: str,
+    max_size: int,
+    time_budget: float | None
+) -> prefix.Vec | None:
+    # get valid completions for this partial sparql query
+    values = get_completions(
+        sparql,
+        current_state,
+        entity_index,
+        property_index,
+        kg,
+        lang,
+        max_size,
+        time_budget=time_budget
+    )
+    if values is None or len(values) == 0:
+        return None
+    return sub_index_cache.get_or_build(index, values)
+
+
 class DecodingState:
+    # all attributes of a decoding state are either immutable or never
+    # modified in place, such that forking a state for a new beam
+    # candidate only needs a shallow copy
     def __init__(
         self,
         initial_token_ids: List[int],
@@ -61,9 +149,10 @@ class DecodingState:
         prop_start_ids: List[int],
         prop_stop_ids: List[int],
         entity_index: prefix.Vec,
-        property_index: prefix.Vec
+        property_index: prefix.Vec,
+        continuations: list[bytes]
     ):
-        self._token_ids = initial_token_ids
+        self._token_ids = TokenList.from_list(initial_token_ids)
         self._initial_length = len(self._token_ids)
 
         # state tracking
@@ -75,37 +164,43 @@ class DecodingState:
         self._prop_stop = prop_stop_ids
         self._overlap_token_id: int | None = None
 
+        # cursor into the index of the current entity / property,
+        # advanced by the continuations of the decoded tokens
+        self._continuations = continuations
+        self._cursor: PrefixCursor | None = None
+
         # value tracking
         self._value: str | None = None
-        self._decoded: list[tuple[str, str]] = []
+        self._decoded: tuple[tuple[str, str], ...] = ()
 
         # indices
         self._ent_index = entity_index
         self._prop_index = property_index
         self._sub_index: prefix.Vec | None = None
+        self._sub_index_future: Future | None = None
 
     def is_ent_start(self) -> bool:
         return (
-            self._token_ids[-len(self._ent_start):] == self._ent_start
+            self._token_ids.endswith(self._ent_start)
             and self._state is None
         )
 
     def is_ent_stop(self) -> bool:
         return (
             self.is_ent() and
-            self._token_ids[-len(self._ent_stop):] == self._ent_stop
+            self._token_ids.endswith(self._ent_stop)
         )
 
     def is_prop_start(self) -> bool:
         return (
-            self._token_ids[-len(self._prop_start):] == self._prop_start
+            self._token_ids.endswith(self._prop_start)
             and self._state is None
         )
 
     def is_prop_stop(self) -> bool:
         return (
             self.is_prop() and
-            self._token_ids[-len(self._prop_stop):] == self._prop_stop
+            self._token_ids.endswith(self._prop_stop)
         )
 
     def is_ent(self) -> bool:
@@ -124,7 +219,15 @@ class DecodingState:
         return self._state is not None
 
     def get_obj_token_ids(self) -> list[int]:
-        return self._token_ids[self._start_idx:]
+        return self._token_ids.tail(len(self._token_ids) - self._start_idx)
+
+    def get_prefix(self) -> bytes:
+        if self._cursor is None:
+            return b""
+        return self._cursor.prefix
+
+    def get_cursor(self) -> PrefixCursor | None:
+        return self._cursor
 
     def get_index(self) -> prefix.Vec | None:
         if self.is_ent():
@@ -136,11 +239,17 @@ class DecodingState:
 
     def calc_overlap(self) -> tuple[int, int]:
         if self.is_ent():
-            overlap = len(longest_overlap(self._token_ids, self._ent_stop))
+            overlap = len(longest_overlap(
+                self._token_ids.tail(len(self._ent_stop)),
+                self._ent_stop
+            ))
             self._overlap_token_id = self._ent_stop[overlap]
             return overlap, self._overlap_token_id
         elif self.is_prop():
-            overlap = len(longest_overlap(self._token_ids, self._prop_stop))
+            overlap = len(longest_overlap(
+                self._token_ids.tail(len(self._prop_stop)),
+                self._prop_stop
+            ))
             self._overlap_token_id = self._prop_stop[overlap]
             return overlap, self._overlap_token_id
         else:
@@ -152,12 +261,19 @@ class DecodingState:
     def calc_sub_index(
         self,
         sparql_fn: Callable[[list[int]], str],
+        submit_fn: Callable[..., Future],
+        sub_index_cache: SubIndexCache,
         kg: str = "wikidata",
         lang: str = "en",
-        max_size: int = 8192
+        max_size: int = 8192,
+        time_budget: float | None = None
     ):
+        # the sub index is calculated in the background, until it
+        # is available the full index is used for constraining,
+        # see update_sub_index
         if (
             self._sub_index is not None
+            or self._sub_index_future is not None
             or self._state is None
             or len(self._decoded) == 0
             or len(self._token_ids) != self._start_idx
@@ -169,7 +285,7 @@ class DecodingState:
         )
         # get sparql up to current entity / property
         sparql = sparql_fn(
-            self._token_ids[self._initial_length:-num_start_ids]
+            self._token_ids.to_list()[self._initial_length:-num_start_ids]
         )
         if self._state == "ent":
             index = self._ent_index
@@ -185,27 +301,48 @@ class DecodingState:
             index = self._prop_index
             current_state = "predicate"
 
-        # get valid completions for this partial sparql query
-        values = get_completions(
+        self._sub_index_future = submit_fn(
+            _calc_sub_index,
             sparql,
             current_state,
+            index,
             self._ent_index,
             self._prop_index,
+            sub_index_cache,
             kg,
             lang,
-            max_size
+            max_size,
+            time_budget
         )
-        if values is None or len(values) == 0:
+
+    def update_sub_index(self):
+        if (
+            self._sub_index_future is None
+            or not self._sub_index_future.done()
+        ):
+            return
+        sub_index = self._sub_index_future.result()
+        self._sub_index_future = None
+        if sub_index is None:
             return
-        self._sub_index = index.get_sub_index_by_values(values)
-        self._sub_index.compute_memo(max_depth=3)
+        # continue from the prefix decoded so far, if it is not
+        # in the sub index we keep using the full index
+        cursor = PrefixCursor(sub_index).advance(self.get_prefix())
+        if cursor.is_empty():
+            return
+        self._sub_index = sub_index
+        self._cursor = cursor
 
     def add(
         self,
         token_id: int,
         value: str | None,
     ):
-        self._token_ids.append(token_id)
+        self._token_ids = self._token_ids.append(token_id)
+        if self._cursor is not None:
+            self._cursor = self._cursor.advance(
+                self._continuations[token_id]
+            )
         if self._overlap_token_id == token_id:
             # set or keep the current value only if we are in overlap
             self._value = value or self._value
@@ -213,35 +350,93 @@ class DecodingState:
             self._value = None
         self._overlap_token_id = None
         if self.is_ent_stop() or self.is_prop_stop():
-            self._decoded.append((self._state, self._value))  # type: ignore
+            self._decoded += ((self._state, self._value),)  # type: ignore
             self._state = None
             self._value = None
             self._sub_index = None
+            self._sub_index_future = None
+            self._cursor = None
         elif self.is_ent_start():
             self._state = "ent"
             self._start_idx = len(self._token_ids)
+            self._cursor = PrefixCursor(self._ent_index)
         elif self.is_prop_start():
             self._state = "prop"
             self._start_idx = len(self._token_ids)
+            self._cursor = PrefixCursor(self._prop_index)
 
     def __deepcopy__(self, memo) -> "DecodingState":
-        state = {
-            name: copy.deepcopy(val, memo)
-            for name, val in self.__dict__.items()
-            if name not in {"_ent_index", "_prop_index", "_sub_index"}
-        }
-        copied = DecodingState(
-            [], [], [], [], [], None, None
-        )
-        copied.__dict__ = {
-            **state,
-            "_ent_index": self._ent_index,
-            "_prop_index": self._prop_index,
-            "_sub_index": self._sub_index
-        }
+        copied = DecodingState.__new__(DecodingState)
+        copied.__dict__ = self.__dict__.copy()
         return copied
 
 
+def select_beam_candidates(
+    scores: torch.Tensor,
+    beam_log_probs: list[float],
+    num_beams: list[int],
+    beam_width: int
+) -> list[list[tuple[int, int, float]]]:
+    # selects the best 2 * beam_width candidates as (beam idx, token id,
+    # log prob) tuples for each batch element, candidates are scored by
+    # the log prob of their beam plus the log prob of their token
+    assert scores.ndim == 2 and scores.shape[0] == sum(num_beams)
+    k = min(beam_width, scores.shape[1])
+    top_k = torch.topk(scores, k, dim=1)
+    totals = top_k.values.double() + torch.tensor(
+        beam_log_probs,
+        dtype=torch.double,
+        device=scores.device
+    )[:, None]
+
+    # pad candidates of all batch elements to the same number of beams,
+    # a stable sort keeps padding behind all actual candidates and
+    # breaks ties by beam and token rank
+    batch_size = len(num_beams)
+    max_beams = max(num_beams)
+    num_beams_t = torch.tensor(num_beams, device=scores.device)
+    batch_idx = torch.repeat_interleave(
+        torch.arange(batch_size, device=scores.device),
+        num_beams_t
+    )
+    offsets = torch.cumsum(num_beams_t, 0) - num_beams_t
+    beam_idx = torch.arange(len(scores), device=scores.device) \
+        - offsets[batch_idx]
+    padded = torch.full(
+        (batch_size, max_beams, k),
+        float("-inf"),
+        dtype=torch.double,
+        device=scores.device
+    )
+    padded[batch_idx, beam_idx] = totals
+    num_select = min(2 * beam_width, max_beams * k)
+    selected = torch.sort(
+        padded.view(batch_size, -1),
+        dim=1,
+        descending=True,
+        stable=True
+    ).indices[:, :num_select]
+
+    selected_beams = torch.div(selected, k, rounding_mode="floor")
+    selected_ranks = selected % k
+    rows = offsets[:, None] + selected_beams
+    # padded positions are cut off below, clamp them to valid rows
+    rows = rows.clamp(max=len(scores) - 1)
+    token_ids = top_k.indices[rows, selected_ranks]
+    log_probs = top_k.values[rows, selected_ranks]
+
+    batch_candidates = []
+    for num, beams, ids, lps in zip(
+        num_beams,
+        selected_beams.tolist(),
+        token_ids.tolist(),
+        log_probs.tolist()
+    ):
+        n = min(2 * beam_width, num * k)
+        batch_candidates.append(list(zip(beams[:n], ids[:n], lps[:n])))
+    return batch_candidates
+
+
 class SPARQLGenerator(TextProcessor):
     task = "SPARQL generation"
 
@@ -389,6 +584,8 @@ class SPARQLGenerator(TextProcessor):
         self._sample_top_k = 5
         self._use_cache = True
         self._subgraph_constraining = False
+        self._completion_max_size = 8192
+        self._completion_time_budget = None
         self._kg = "wikidata"
         self._lang = "en"
         self._max_length = None
@@ -398,13 +595,28 @@ class SPARQLGenerator(TextProcessor):
         self._property_index = None
         self._example_index = None
 
-        self._continuations = [
-            self.output_tokenizer.de_tokenize(
-                [self._eos_token_id, i, self._eos_token_id],
-                False
-            )[len(eos_token):-len(eos_token)].encode("utf8")
-            for i in range(self.output_tokenizer.vocab_size())
-        ]
+        self._continuations = load_continuations(
+            self.output_tokenizer,
+            self.cfg["output_tokenizer"],
+            eos_token
+        )
+        self._continuation_lookup = continuation_lookup(self._continuations)
+        self._mask_cache = MaskCache(128)
+        self._mask_tables: dict[int, MaskTable] = {}
+        self._mask_buffer = MaskBuffer()
+        self._vocab_size = self.output_tokenizer.vocab_size()
+
+        # completion queries for subgraph constraining run in the
+        # background, such that they overlap with decoding; identical
+        # queries within a batch (e.g. from different beams) share
+        # a single future
+        self._completion_executor = ThreadPoolExecutor(
+            max_workers=8,
+            thread_name_prefix="completions"
+        )
+        self._completion_futures: dict[tuple, Future] = {}
+        # sub indices are reused across beams and requests
+        self._sub_index_cache = SubIndexCache(2 ** 20)
 
         def _sparql_from_token_ids(
             token_ids: list[int]
@@ -468,7 +680,8 @@ class SPARQLGenerator(TextProcessor):
             self._bop_ids,
             self._eop_ids,
             self._entity_index,
-            self._property_index
+            self._property_index,
+            self._continuations
         )
 
     def _update_cont_mask_and_values(
@@ -478,31 +691,149 @@ class SPARQLGenerator(TextProcessor):
         decoding_states: list[DecodingState],
     ) -> tuple[torch.Tensor, list[str | None]]:
         assert cont_mask.shape[0] == len(values) == len(decoding_states)
+        # rows sharing the same index and prefix (e.g. beams within the
+        # same entity) are deduplicated and looked up in the mask cache;
+        # for the remaining prefixes, cursors that narrowed the index down
+        # to a few keys compute their continuations directly, all other
+        # prefixes are grouped by index, such that their masks are
+        # computed with a single batched index call
+        key_rows: dict[tuple[int, bytes], list[int]] = {}
+        results: dict[
+            tuple[int, bytes],
+            tuple[torch.Tensor | list[int], str | None]
+        ] = {}
+        pending: dict[int, tuple[prefix.Vec, list[bytes]]] = {}
         for i, state in enumerate(decoding_states):
-            index = state.get_index()
-            if index is None:
+            cursor = state.get_cursor()
+            if cursor is None:
+                continue
+            key = (id(cursor.index), cursor.prefix)
+            if key in key_rows:
+                key_rows[key].append(i)
+                self._mask_cache.record_hit()
+                continue
+            key_rows[key] = [i]
+            cached = self._mask_cache.get(cursor.index, cursor.prefix)
+            if cached is not None:
+                results[key] = cached
+                continue
+            table = self._mask_tables.get(key[0])
+            precomputed = table.get(cursor.prefix) if table else None
+            if precomputed is not None:
+                packed, value = precomputed
+                results[key] = (
+                    torch.from_numpy(table.unpack(packed)),
+                    value
+                )
+                self._mask_cache.put(cursor.index, cursor.prefix, results[key])
+                continue
+            conts = cursor.continuations(self._continuation_lookup)
+            if conts is not None:
+                results[key] = conts
+                self._mask_cache.put(cursor.index, cursor.prefix, conts)
+                continue
+            _, prefixes = pending.setdefault(key[0], (cursor.index, []))
+            prefixes.append(cursor.prefix)
+
+        for index, prefixes in pending.values():
+            masks, index_values = index.batch_continuation_mask(prefixes)
+            # converting all masks of an index at once via numpy is
+            # much faster than converting them one by one
+            dense = torch.from_numpy(np.array(masks, dtype=bool))
+            for pfx, mask, value in zip(prefixes, dense, index_values):
+                results[(id(index), pfx)] = (mask, value)
+                self._mask_cache.put(index, pfx, (mask, value))
+
+        dense_rows = []
+        dense_masks = []
+        sparse_rows = []
+        sparse_token_ids = []
+        for key, rows in key_rows.items():
+            mask, value = results[key]
+            for i in rows:
+                values[i] = value
+            if isinstance(mask, torch.Tensor):
+                dense_rows.extend(rows)
+                dense_masks.extend(mask for _ in rows)
+            else:
+                sparse_rows.extend(rows)
+                sparse_token_ids.extend(mask for _ in rows)
+
+        scatter_continuations(
+            cont_mask,
+            dense_rows,
+            dense_masks,
+            sparse_rows,
+            sparse_token_ids
+        )
+
+        overlap_rows = []
+        overlap_token_ids = []
+        overlap_valid = []
+        for i, state in enumerate(decoding_states):
+            if state.get_cursor() is None:
                 continue
-            token_ids = state.get_obj_token_ids()
-            prefix = self.output_tokenizer.de_tokenize(
-                token_ids,
-                False
-            ).lstrip().encode("utf8")
-            mask, value = index.continuation_mask(prefix)
             overlap, overlap_token_id = state.calc_overlap()
-            valid_cont = (
-                (overlap == 0 and value is not None)
+            overlap_rows.append(i)
+            overlap_token_ids.append(overlap_token_id)
+            overlap_valid.append(
+                (overlap == 0 and values[i] is not None)
                 or
                 (overlap > 0 and state.has_value())
             )
-            mask[overlap_token_id] = valid_cont
-            cont_mask[i, :len(mask)] = torch.tensor(
-                mask,
-                dtype=torch.bool,
-                device=cont_mask.device
-            )
-            values[i] = value
+
+        if len(overlap_rows) > 0:
+            device = cont_mask.device
+            cont_mask[
+                torch.tensor(overlap_rows, device=device),
+                torch.tensor(overlap_token_ids, device=device)
+            ] = torch.tensor(overlap_valid, dtype=torch.bool, device=device)
         return cont_mask, values
 
+    def _mask_scores(
+        self,
+        scores: torch.Tensor,
+        decoding_states: list[DecodingState]
+    ) -> list[str | None]:
+        assert len(decoding_states) == scores.shape[0], \
+            "expected one decoding state per row of the scores"
+        # tokens outside of the output vocabulary are never valid
+        scores[..., self._vocab_size:] = float("-inf")
+        values: list[str | None] = [None for _ in range(len(scores))]
+
+        if self._subgraph_constraining:
+            for state in decoding_states:
+                state.update_sub_index()
+
+        # only rows inside entities or properties need a mask,
+        # for all other rows we are done
+        rows = [
+            i for i, state in enumerate(decoding_states)
+            if state.get_cursor() is not None
+        ]
+        if len(rows) == 0:
+            return values
+
+        # masks are built and applied on the device of the scores
+        conts = self._mask_buffer.get(
+            len(rows),
+            scores.shape[1],
+            scores.device
+        )
+        conts, row_values = self._update_cont_mask_and_values(
+            conts,
+            [None for _ in rows],
+            [decoding_states[i] for i in rows]
+        )
+        row_indices = torch.tensor(rows, device=scores.device)
+        scores[row_indices] = scores[row_indices].masked_fill(
+            torch.logical_not(conts),
+            float("-inf")
+        )
+        for i, value in zip(rows, row_values):
+            values[i] = value
+        return values
+
     def _index_select_fn(
         self,
         decoding_states: List[DecodingState],
@@ -511,20 +842,12 @@ class SPARQLGenerator(TextProcessor):
             scores: torch.Tensor,
             indices: List[int]
         ) -> Tuple[torch.Tensor, torch.Tensor]:
-            conts = torch.ones(
-                *scores.shape,
-                dtype=torch.bool
+            # scores are only given for the rows of the
+            # sequences that are still active
+            values = self._mask_scores(
+                scores,
+                [decoding_states[i] for i in indices]
             )
-            conts[..., self.output_tokenizer.vocab_size():] = False
-            values: list[str | None] = [None for _ in range(len(conts))]
-
-            conts, values = self._update_cont_mask_and_values(
-                conts,
-                values,
-                decoding_states
-            )
-
-            scores[torch.logical_not(conts)] = float("-inf")
             token_ids = torch.argmax(scores, -1)
             scores = torch.gather(scores, -1, token_ids[:, None]).squeeze(-1)
 
@@ -538,8 +861,12 @@ class SPARQLGenerator(TextProcessor):
                 if self._subgraph_constraining:
                     decoding_states[idx].calc_sub_index(
                         self._sparql_from_token_ids,
+                        self._submit_completion,
+                        self._sub_index_cache,
                         self._kg,
-                        self._lang
+                        self._lang,
+                        self._completion_max_size,
+                        self._completion_time_budget
                     )
 
             return token_ids, scores
@@ -552,13 +879,6 @@ class SPARQLGenerator(TextProcessor):
             batch_beams: List[List[Beam]],
             _: List[int]
         ) -> List[List[Beam]]:
-            conts = torch.ones(
-                *scores.shape,
-                dtype=torch.bool
-            )
-            conts[..., self.output_tokenizer.vocab_size():] = False
-            values: list[str | None] = [None for _ in range(len(conts))]
-
             decoding_states = []
             for beams in batch_beams:
                 for beam in beams:
@@ -570,74 +890,83 @@ class SPARQLGenerator(TextProcessor):
                             self._bop_ids,
                             self._eop_ids,
                             self._entity_index,
-                            self._property_index
+                            self._property_index,
+                            self._continuations
                         )
                     decoding_states.append(beam.info["state"])
 
-            conts, values = self._update_cont_mask_and_values(
-                conts,
-                values,
-                decoding_states
-            )
-
-            scores[torch.logical_not(conts)] = float("-inf")
+            values = self._mask_scores(scores, decoding_states)
 
             num_beams = [len(b) for b in batch_beams]
-            assert scores.ndim == 2 and scores.shape[0] == sum(num_beams)
-            k = min(self._beam_width, scores.shape[1])
-            top_k = torch.topk(scores, k, dim=1)
+            selected = select_beam_candidates(
+                scores,
+                [beam.log_prob for beams in batch_beams for beam in beams],
+                num_beams,
+                self._beam_width
+            )
+
+            # only materialize beams for the selected candidates
             batch_start = 0
             batch_candidates = []
-            for beams, num in zip(  # type: ignore
+            for beams, num, candidates in zip(
                 batch_beams,
-                num_beams
+                num_beams,
+                selected
             ):
-                top_k_indices = top_k.indices[batch_start:batch_start + num]
-                top_k_log_probs = top_k.values[batch_start:batch_start + num]
-                top_k_values = values[batch_start:batch_start + num]
-                assert len(top_k_log_probs) == len(top_k_values)
-                batch_start += num
-                # create candidates
-                candidates = []
-                for idx, (token_ids, log_probs) in enumerate(zip(
-                    top_k_indices.tolist(),  # type: ignore
-                    top_k_log_probs.tolist()
-                )):
-                    for token_id, log_p in zip(token_ids, log_probs):
-                        candidates.append((
-                            idx,
-                            token_id,
-                            log_p
-                        ))
-                # sort candidates by score
-                candidates = sorted(
-                    candidates,
-                    key=lambda item: -(beams[item[0]].log_prob + item[2]),
-                )[:2 * self._beam_width]
-                # convert candidates to beams
                 candidate_beams = []
                 for idx, token_id, log_p in candidates:
                     beam = Beam.from_beam(beams[idx], log_p, token_id)
                     state: DecodingState = beam.info["state"]
-                    state.add(token_id, top_k_values[idx])
+                    state.add(token_id, values[batch_start + idx])
                     if self._subgraph_constraining:
                         state.calc_sub_index(
                             self._sparql_from_token_ids,
+                            self._submit_completion,
+                            self._sub_index_cache,
                             self._kg,
-                            self._lang
+                            self._lang,
+                            self._completion_max_size,
+                            self._completion_time_budget
                         )
                     candidate_beams.append(beam)
                 batch_candidates.append(candidate_beams)
+                batch_start += num
 
             return batch_candidates
 
         return _fn
 
+    def _submit_completion(self, fn: Callable, *args: Any) -> Future:
+        key = (fn,) + tuple(
+            id(arg) if isinstance(arg, prefix.Vec) else arg
+            for arg in args
+        )
+        future = self._completion_futures.get(key)
+        if future is None:
+            future = self._completion_executor.submit(fn, *args)
+            self._completion_futures[key] = future
+        return future
+
     def _inference(
         self,
         inputs: Dict[str, Any],
+    ) -> list[Any]:
+        try:
+            return self._search(inputs)
+        finally:
+            # completion queries that have not started yet are
+            # no longer needed once the batch is finished
+            for future in self._completion_futures.values():
+                future.cancel()
+            self._completion_futures.clear()
+
+    def _search(
+        self,
+        inputs: Dict[str, Any],
     ) -> list[Any]:
         batch_size = len(inputs["token_ids"])
+        # masks are only cached per request
+        self._mask_cache.clear()
         inference_kwargs = {}
         if self._is_encoder_decoder:
             enc = self.model.encode(**inputs)
@@ -786,6 +1115,9 @@ class SPARQLGenerator(TextProcessor):
         lang: str = "en",
         max_length: int | None = None,
         use_cache: bool = True,
+        mask_cache_size: int = 128,
+        completion_max_size: int = 8192,
+        completion_time_budget: float | None = None,
     ) -> None:
         assert strategy in ["greedy", "beam", "sample"]
         self._strategy = strategy
@@ -797,6 +1129,15 @@ class SPARQLGenerator(TextProcessor):
         self._lang = lang
         self._max_length = max_length
         self._use_cache = use_cache
+        self._mask_cache.max_size = mask_cache_size
+        self._completion_max_size = completion_max_size
+        self._completion_time_budget = completion_time_budget
+
+    def mask_cache_stats(self) -> dict[str, Any]:
+        return self._mask_cache.stats()
+
+    def sub_index_cache_stats(self) -> dict[str, Any]:
+        return self._sub_index_cache.stats()
 
     def set_indices(
         self,
@@ -804,31 +1145,52 @@ class SPARQLGenerator(TextProcessor):
         property_index: Optional[Union[str, prefix.Vec]] = None,
         example_index: Optional[Union[str, vector.Index]] = None,
     ) -> None:
+        if entity_index is not None or property_index is not None:
+            # cached sub indices of replaced indices are no longer used
+            self._sub_index_cache.clear()
+
         if entity_index is not None:
-            if isinstance(entity_index, str):
-                entity_index = prefix.Vec.load(entity_index)
-            self._entity_index = entity_index
-            self._entity_index.compute_memo(max_depth=3)  # type: ignore
-            self._entity_index.set_continuations(
-                self._continuations,
-                max_depth=1
-            )
+            if self._entity_index is not None:
+                self._mask_tables.pop(id(self._entity_index), None)
+            self._entity_index = self._load_prefix_index(entity_index)
 
         if property_index is not None:
-            if isinstance(property_index, str):
-                property_index = prefix.Vec.load(property_index)
-            self._property_index = property_index
-            self._property_index.compute_memo(max_depth=3)  # type: ignore
-            self._property_index.set_continuations(
-                self._continuations,
-                max_depth=1
-            )
+            if self._property_index is not None:
+                self._mask_tables.pop(id(self._property_index), None)
+            self._property_index = self._load_prefix_index(property_index)
 
         if example_index is not None:
             if isinstance(example_index, str):
                 example_index = vector.Index.load(example_index)
             self._example_index = example_index
 
+    def _load_prefix_index(self, index: Union[str, prefix.Vec]) -> prefix.Vec:
+        table = None
+        if isinstance(index, str):
+            # use precomputed continuation masks saved next to the index
+            # if available, see scripts/build_mask_tables.py
+            table_path = f"{index}.masks"
+            index = prefix.Vec.load(index)
+            if MaskTable.exists(table_path):
+                table = MaskTable.load(table_path)
+                if table.fingerprint != continuations_fingerprint(
+                    self._continuations
+                ):
+                    self.logger.warning(
+                        f"ignoring mask table at {table_path}, "
+                        "it was built with a different output tokenizer"
+                    )
+                    table = None
+
+        if table is not None:
+            self._mask_tables[id(index)] = table
+        if table is None or table.max_depth < 3:
+            # prefixes deeper than the mask table still benefit
+            # from the memoization
+            index.compute_memo(max_depth=3)  # type: ignore
+        index.set_continuations(self._continuations, max_depth=1)
+        return index
+
     @ property
     def has_kg_indices(self) -> bool:
         return self._entity_index is not None \
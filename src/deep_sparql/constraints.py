@@ -0,0 +1,540 @@
+import hashlib
+import json
+import os
+import threading
+import zipfile
+from collections import OrderedDict
+from typing import Any, Callable
+
+import numpy as np
+import torch
+
+from text_utils import prefix, tokenization
+
+
+def compute_continuations(
+    tokenizer: tokenization.Tokenizer,
+    eos_token: str
+) -> list[bytes]:
+    # surround every token with eos tokens to get its continuation
+    # including leading whitespace
+    eos_token_id = tokenizer.special_token_to_id(eos_token)
+    return [
+        tokenizer.de_tokenize(
+            [eos_token_id, i, eos_token_id],
+            False
+        )[len(eos_token):-len(eos_token)].encode("utf8")
+        for i in range(tokenizer.vocab_size())
+    ]
+
+
+def load_continuations(
+    tokenizer: tokenization.Tokenizer,
+    tokenizer_cfg: dict[str, Any],
+    eos_token: str,
+    cache_dir: str | None = None
+) -> list[bytes]:
+    # continuations are cached on disk as one contiguous buffer
+    # with offsets, keyed by the tokenizer config and files
+    if cache_dir is None:
+        cache_dir = os.environ.get(
+            "SPARQL_CACHE_DIR",
+            os.path.join(os.path.expanduser("~"), ".cache", "deep_sparql")
+        )
+    h = hashlib.sha256(
+        json.dumps(tokenizer_cfg, sort_keys=True, default=str).encode("utf8")
+    )
+    h.update(eos_token.encode("utf8"))
+    tokenizer_path = tokenizer_cfg.get("tokenize", {}).get("path")
+    if tokenizer_path is not None and os.path.isfile(tokenizer_path):
+        with open(tokenizer_path, "rb") as f:
+            h.update(f.read())
+    path = os.path.join(cache_dir, f"continuations_{h.hexdigest()}.npz")
+
+    if os.path.exists(path):
+        try:
+            return _load_cached_continuations(path, tokenizer.vocab_size())
+        except (
+            OSError,
+            EOFError,
+            KeyError,
+            ValueError,
+            zipfile.BadZipFile
+        ):
+            # truncated or corrupt cache file, recompute it
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    continuations = compute_continuations(tokenizer, eos_token)
+    offsets = np.zeros(len(continuations) + 1, dtype=np.int64)
+    np.cumsum([len(cont) for cont in continuations], out=offsets[1:])
+    # write to a temporary file first, such that concurrent
+    # processes never load a partially written file
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(
+            tmp_path,
+            buffer=np.frombuffer(b"".join(continuations), dtype=np.uint8),
+            offsets=offsets
+        )
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+    return continuations
+
+
+def _load_cached_continuations(path: str, vocab_size: int) -> list[bytes]:
+    with np.load(path) as data:
+        buffer = data["buffer"].tobytes()
+        offsets = data["offsets"].tolist()
+    if (
+        len(offsets) != vocab_size + 1
+        or offsets[0] != 0
+        or offsets[-1] != len(buffer)
+        or any(a > b for a, b in zip(offsets, offsets[1:]))
+    ):
+        raise ValueError(f"invalid continuations cache file {path}")
+    return [
+        buffer[offsets[i]:offsets[i + 1]]
+        for i in range(len(offsets) - 1)
+    ]
+
+
+def continuations_fingerprint(continuations: list[bytes]) -> str:
+    h = hashlib.sha256()
+    for cont in continuations:
+        h.update(len(cont).to_bytes(4, "little"))
+        h.update(cont)
+    return h.hexdigest()
+
+
+def continuation_lookup(
+    continuations: list[bytes]
+) -> dict[bytes, list[int]]:
+    lookup: dict[bytes, list[int]] = {}
+    for token_id, cont in enumerate(continuations):
+        if len(cont) == 0:
+            continue
+        lookup.setdefault(cont, []).append(token_id)
+    return lookup
+
+
+class PrefixCursor:
+    # emulates a cursor into a prefix index by keeping track of the
+    # range of (sorted) index keys that start with the current prefix,
+    # advancing the cursor only searches within the previous range;
+    # once the range is small enough its keys are materialized and
+    # continuations are computed without going back to the index
+    def __init__(
+        self,
+        index: prefix.Vec,
+        prefix: bytes = b"",
+        lo: int = 0,
+        hi: int | None = None,
+        keys: list[tuple[bytes, str]] | None = None,
+        max_keys: int = 64
+    ):
+        self.index = index
+        self.prefix = prefix
+        self._lo = lo
+        self._hi = len(index) if hi is None else hi
+        self._keys = keys
+        self._max_keys = max_keys
+
+    def _key(self, idx: int) -> bytes:
+        return bytes(self.index.at(idx)[0])
+
+    def _bisect(
+        self,
+        lo: int,
+        hi: int,
+        cond: Callable[[bytes], bool]
+    ) -> int:
+        # first index in [lo, hi) for which cond does not hold
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if cond(self._key(mid)):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def advance(self, continuation: bytes) -> "PrefixCursor":
+        if len(self.prefix) == 0:
+            # leading whitespace is ignored for index lookups
+            continuation = continuation.lstrip()
+        if len(continuation) == 0:
+            return self
+
+        pfx = self.prefix + continuation
+        if self._keys is not None:
+            return PrefixCursor(
+                self.index,
+                pfx,
+                keys=[
+                    (key, value) for key, value in self._keys
+                    if key.startswith(pfx)
+                ],
+                max_keys=self._max_keys
+            )
+
+        n = len(pfx)
+        lo = self._bisect(self._lo, self._hi, lambda k: k[:n] < pfx)
+        hi = self._bisect(lo, self._hi, lambda k: k[:n] == pfx)
+        keys = None
+        if hi - lo <= self._max_keys:
+            keys = []
+            for idx in range(lo, hi):
+                key, value = self.index.at(idx)
+                keys.append((bytes(key), value))
+        return PrefixCursor(
+            self.index,
+            pfx,
+            lo,
+            hi,
+            keys,
+            self._max_keys
+        )
+
+    def is_empty(self) -> bool:
+        if self._keys is not None:
+            return len(self._keys) == 0
+        return self._lo >= self._hi
+
+    def continuations(
+        self,
+        lookup: dict[bytes, list[int]]
+    ) -> tuple[list[int], str | None] | None:
+        # returns the ids of all tokens that are valid continuations
+        # of the current prefix and the value of the prefix, or None
+        # if the range of keys is too large and the index should be
+        # queried instead
+        if self._keys is None or len(self.prefix) == 0:
+            return None
+        n = len(self.prefix)
+        allowed = set()
+        value = None
+        for key, val in self._keys:
+            if len(key) == n:
+                value = val
+                continue
+            for i in range(n + 1, len(key) + 1):
+                allowed.update(lookup.get(key[n:i], ()))
+        return sorted(allowed), value
+
+
+class MaskCache:
+    # lru cache for continuation masks keyed by index identity and
+    # prefix, entries keep a reference to their index such that its
+    # id cannot be reused while the entry is alive
+    def __init__(self, max_size: int = 0):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[
+            tuple[int, bytes],
+            tuple[prefix.Vec, Any]
+        ] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, index: prefix.Vec, pfx: bytes) -> Any | None:
+        key = (id(index), pfx)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, index: prefix.Vec, pfx: bytes, mask: Any):
+        if self.max_size <= 0:
+            return
+        key = (id(index), pfx)
+        self._entries[key] = (index, mask)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def record_hit(self):
+        # for lookups deduplicated outside of the cache,
+        # e.g. beams sharing a prefix within a decoding step
+        self.hits += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "size": len(self),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate
+        }
+
+
+class SubIndexCache:
+    # thread safe lru cache for sub indices keyed by their base index
+    # and the values they were built from, bounded by the total number
+    # of keys in all cached sub indices
+    def __init__(self, max_keys: int = 0):
+        self.max_keys = max_keys
+        self.num_keys = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[
+            tuple[int, frozenset[str]],
+            tuple[prefix.Vec, prefix.Vec]
+        ] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_or_build(
+        self,
+        index: prefix.Vec,
+        values: list[str]
+    ) -> prefix.Vec:
+        key = (id(index), frozenset(values))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        # build outside of the lock, such that different sub indices
+        # can be built concurrently
+        sub_index = index.get_sub_index_by_values(values)
+        sub_index.compute_memo(max_depth=3)
+        size = len(sub_index)
+        if size > self.max_keys:
+            return sub_index
+
+        with self._lock:
+            if key in self._entries:
+                return self._entries[key][1]
+            self._entries[key] = (index, sub_index)
+            self.num_keys += size
+            while self.num_keys > self.max_keys:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.num_keys -= len(evicted)
+        return sub_index
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.num_keys = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "size": len(self),
+            "num_keys": self.num_keys,
+            "max_keys": self.max_keys,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate
+        }
+
+
+class MaskTable:
+    # continuation masks for all prefixes of an index up to a given
+    # depth in tokens, stored as packed bitsets (one row per prefix)
+    # that can be saved next to the index and memory mapped on load
+    def __init__(
+        self,
+        masks: np.ndarray,
+        prefixes: dict[bytes, int],
+        values: list[str | None],
+        num_tokens: int,
+        fingerprint: str,
+        max_depth: int = 1
+    ):
+        assert masks.ndim == 2 and len(masks) == len(values)
+        self.masks = masks
+        self.prefixes = prefixes
+        self.values = values
+        self.num_tokens = num_tokens
+        self.fingerprint = fingerprint
+        self.max_depth = max_depth
+
+    @staticmethod
+    def build(
+        index: prefix.Vec,
+        continuations: list[bytes],
+        max_depth: int = 1,
+        batch_size: int = 64
+    ) -> "MaskTable":
+        prefixes: dict[bytes, int] = {}
+        masks = []
+        values = []
+        level = [b""]
+        for depth in range(max_depth + 1):
+            next_level = []
+            for i in range(0, len(level), batch_size):
+                batch = level[i:i + batch_size]
+                batch_masks, batch_values = index.batch_continuation_mask(
+                    batch
+                )
+                batch_masks = np.array(batch_masks, dtype=bool)
+                for pfx, mask, value in zip(batch, batch_masks, batch_values):
+                    prefixes[pfx] = len(values)
+                    values.append(value)
+                    if depth == max_depth:
+                        continue
+                    for token_id in np.flatnonzero(mask):
+                        cont = continuations[token_id]
+                        child = pfx + cont if pfx else cont.lstrip()
+                        if child and child not in prefixes:
+                            next_level.append(child)
+                masks.append(np.packbits(batch_masks, axis=1))
+            level = list(dict.fromkeys(next_level))
+
+        return MaskTable(
+            np.concatenate(masks),
+            prefixes,
+            values,
+            len(continuations),
+            continuations_fingerprint(continuations),
+            max_depth
+        )
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return (
+            os.path.exists(f"{path}.npy")
+            and os.path.exists(f"{path}.json")
+        )
+
+    def save(self, path: str):
+        np.save(f"{path}.npy", self.masks)
+        with open(f"{path}.json", "w", encoding="utf8") as f:
+            json.dump({
+                "prefixes": [
+                    pfx.hex()
+                    for pfx, _ in sorted(
+                        self.prefixes.items(),
+                        key=lambda item: item[1]
+                    )
+                ],
+                "values": self.values,
+                "num_tokens": self.num_tokens,
+                "fingerprint": self.fingerprint,
+                "max_depth": self.max_depth
+            }, f)
+
+    @staticmethod
+    def load(path: str) -> "MaskTable":
+        masks = np.load(f"{path}.npy", mmap_mode="r")
+        with open(f"{path}.json", "r", encoding="utf8") as f:
+            info = json.load(f)
+        return MaskTable(
+            masks,
+            {
+                bytes.fromhex(pfx): i
+                for i, pfx in enumerate(info["prefixes"])
+            },
+            info["values"],
+            info["num_tokens"],
+            info["fingerprint"],
+            # tables saved before the depth was stored have depth 1
+            info.get("max_depth", 1)
+        )
+
+    def get(self, pfx: bytes) -> tuple[np.ndarray, str | None] | None:
+        # returns a view of the packed mask, no data is copied
+        idx = self.prefixes.get(pfx)
+        if idx is None:
+            return None
+        return self.masks[idx], self.values[idx]
+
+    def unpack(self, packed: np.ndarray) -> np.ndarray:
+        return np.unpackbits(packed, count=self.num_tokens).view(bool)
+
+
+class MaskBuffer:
+    # reusable boolean mask on the device of the scores, such that
+    # continuation masks are assembled and applied without allocating
+    # a new mask and copying it to the device at every decoding step
+    def __init__(self):
+        self._buffer: torch.Tensor | None = None
+
+    def get(
+        self,
+        rows: int,
+        cols: int,
+        device: torch.device
+    ) -> torch.Tensor:
+        buffer = self._buffer
+        if (
+            buffer is None
+            or buffer.device != device
+            or buffer.shape[0] < rows
+            or buffer.shape[1] < cols
+        ):
+            if buffer is not None and buffer.device == device:
+                rows = max(rows, buffer.shape[0])
+                cols = max(cols, buffer.shape[1])
+            buffer = torch.empty(rows, cols, dtype=torch.bool, device=device)
+            self._buffer = buffer
+        mask = buffer[:rows, :cols]
+        mask.fill_(True)
+        return mask
+
+
+def scatter_continuations(
+    mask: torch.Tensor,
+    dense_rows: list[int],
+    dense_masks: list[torch.Tensor],
+    sparse_rows: list[int],
+    sparse_token_ids: list[list[int]]
+):
+    # writes continuation masks into the given mask, dense masks are
+    # copied to the device in one go, sparse masks are sent as flat
+    # index lists and scattered on the device
+    device = mask.device
+    if len(dense_rows) > 0:
+        dense = torch.stack(dense_masks).to(device, non_blocking=True)
+        mask[
+            torch.tensor(dense_rows, device=device),
+            :dense.shape[1]
+        ] = dense
+
+    if len(sparse_rows) > 0:
+        num_tokens = torch.tensor(
+            [len(ids) for ids in sparse_token_ids]
+        )
+        rows = torch.tensor(sparse_rows)
+        token_ids = torch.tensor(
+            [token_id for ids in sparse_token_ids for token_id in ids],
+            dtype=torch.long
+        )
+        mask[rows.to(device, non_blocking=True)] = False
+        mask[
+            torch.repeat_interleave(rows, num_tokens).to(
+                device,
+                non_blocking=True
+            ),
+            token_ids.to(device, non_blocking=True)
+        ] = True
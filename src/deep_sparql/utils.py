@@ -1,8 +1,31 @@
 import re
+import sys
+import json
+import time
 import uuid
+import sqlite3
+import hashlib
+import itertools
+import threading
 import requests
-from typing import Dict, List, Callable, Tuple, Optional, Set
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import (
+    Any,
+    Dict,
+    List,
+    Callable,
+    Iterable,
+    Iterator,
+    Tuple,
+    Optional,
+    Set
+)
 
+import numpy as np
 from tqdm import tqdm
 
 from text_utils import prefix, tokenization, text
@@ -506,6 +529,8 @@ def _qlever_ask_to_select_post_fn(
 
 
 class SPARQLRecord:
+    __slots__ = ("value", "data_type", "label")
+
     def __init__(
         self,
         value: str,
@@ -526,54 +551,556 @@ class SPARQLRecord:
             return self.label or self.value
 
 
+class SPARQLRow:
+    # view on a single row of a sparql result,
+    # records are only created when accessed
+    __slots__ = ("_result", "_idx")
+
+    def __init__(self, result: "SPARQLResult", idx: int):
+        self._result = result
+        self._idx = idx
+
+    def __contains__(self, var: str) -> bool:
+        values = self._result.values.get(var)
+        return values is not None and values[self._idx] is not None
+
+    def __getitem__(self, var: str) -> SPARQLRecord:
+        record = self.get(var)
+        if record is None:
+            raise KeyError(var)
+        return record
+
+    def get(
+        self,
+        var: str,
+        default: SPARQLRecord | None = None
+    ) -> SPARQLRecord | None:
+        if var not in self:
+            return default
+        return SPARQLRecord(
+            self._result.values[var][self._idx],  # type: ignore
+            self._result.types[var][self._idx],  # type: ignore
+            self._result.labels[var][self._idx]
+        )
+
+    def __repr__(self) -> str:
+        return repr({
+            var: self[var]
+            for var in self._result.vars
+            if var in self
+        })
+
+
 class SPARQLResult:
+    # columnar sparql result with values, types and labels per
+    # variable, unbound values are None
     def __init__(
         self,
         vars: List[str],
-        results: List[Dict[str, SPARQLRecord]]
+        values: Dict[str, List[str | None]],
+        types: Dict[str, List[str | None]],
+        labels: Dict[str, List[str | None]] | None = None
     ):
         self.vars = vars
-        self.results = results
+        self.values = values
+        self.types = types
+        self._num_rows = len(values[vars[0]]) if len(vars) > 0 else 0
+        if labels is None:
+            labels = {
+                var: [None] * self._num_rows
+                for var in vars
+            }
+        self.labels = labels
+
+    @staticmethod
+    def from_bindings(
+        vars: List[str],
+        bindings: Iterator[Dict[str, Any]],
+        names: List[str] | None = None
+    ) -> "SPARQLResult":
+        # optionally renames the variables of the bindings to names
+        if names is None:
+            names = vars
+        values: Dict[str, List[str | None]] = {name: [] for name in names}
+        types: Dict[str, List[str | None]] = {name: [] for name in names}
+        columns = [
+            (var, values[name].append, types[name].append)
+            for var, name in zip(vars, names)
+        ]
+        for binding in bindings:
+            for var, add_value, add_type in columns:
+                value = binding.get(var)
+                if value is None:
+                    add_value(None)
+                    add_type(None)
+                else:
+                    add_value(value["value"])
+                    # there are only a few distinct types
+                    add_type(sys.intern(value["type"]))
+        return SPARQLResult(names, values, types)
+
+    @staticmethod
+    def from_rows(
+        vars: List[str],
+        rows: Iterator[List[Tuple[str, str] | None]]
+    ) -> "SPARQLResult":
+        # rows of (value, type) pairs, None for unbound values
+        values: Dict[str, List[str | None]] = {var: [] for var in vars}
+        types: Dict[str, List[str | None]] = {var: [] for var in vars}
+        columns = [
+            (values[var].append, types[var].append)
+            for var in vars
+        ]
+        for row in rows:
+            for (add_value, add_type), term in zip(columns, row):
+                if term is None:
+                    add_value(None)
+                    add_type(None)
+                else:
+                    add_value(term[0])
+                    add_type(term[1])
+        return SPARQLResult(vars, values, types)
 
     def __len__(self) -> int:
-        return len(self.results)
+        return self._num_rows
+
+    def column(self, var: str) -> List[str | None]:
+        return self.values[var]
+
+    def row(self, idx: int) -> SPARQLRow:
+        return SPARQLRow(self, idx)
+
+    def rows(self) -> Iterator[SPARQLRow]:
+        for i in range(len(self)):
+            yield SPARQLRow(self, i)
+
+    @property
+    def results(self) -> List[SPARQLRow]:
+        return list(self.rows())
+
+    def tuples(self, default: str = "") -> Iterator[Tuple[str, ...]]:
+        # value tuples over all variables, with default for unbound ones
+        columns = [self.values[var] for var in self.vars]
+        for row in zip(*columns):
+            yield tuple(default if v is None else v for v in row)
+
+    def set_labels(self, var: str, labels: List[str | None]):
+        labels = labels[:len(self)]
+        self.labels[var] = labels + [None] * (len(self) - len(labels))
 
     def __repr__(self) -> str:
         return f"SPARQLResult({self.vars}, {self.results})"
 
 
+class RateLimiter:
+    # thread safe limiter spacing out calls to acquire evenly
+    def __init__(self, max_per_second: float):
+        assert max_per_second > 0, "max per second must be positive"
+        self.interval = 1.0 / max_per_second
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class QLeverClient:
+    # http client for qlever endpoints reusing pooled keep-alive
+    # connections, with timeouts, retries with exponential backoff,
+    # a limit on concurrent requests and an optional rate limit
+    # per endpoint
+    def __init__(
+        self,
+        connect_timeout: float = 10.0,
+        read_timeout: float = 120.0,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        max_concurrent: int = 16,
+        max_requests_per_second: float | None = None
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_concurrent = max_concurrent
+        self.max_requests_per_second = max_requests_per_second
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+            # return the last response instead of raising, such that
+            # qlever error messages are kept
+            raise_on_status=False
+        )
+        self.session = self._session(max_concurrent, retry)
+        # requests with a time budget are never retried, a retry
+        # with backoff would exceed the budget
+        self._budget_session = self._session(max_concurrent, 0)
+        self._semaphores: dict[str, threading.BoundedSemaphore] = {}
+        self._rate_limiters: dict[str, RateLimiter] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _session(max_concurrent: int, retry: Retry | int) -> requests.Session:
+        adapter = HTTPAdapter(
+            pool_connections=len(QLEVER_URLS),
+            pool_maxsize=max_concurrent,
+            max_retries=retry
+        )
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def _semaphore(self, endpoint: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            if endpoint not in self._semaphores:
+                self._semaphores[endpoint] = threading.BoundedSemaphore(
+                    self.max_concurrent
+                )
+            return self._semaphores[endpoint]
+
+    def _rate_limiter(self, endpoint: str) -> RateLimiter | None:
+        if self.max_requests_per_second is None:
+            return None
+        with self._lock:
+            if endpoint not in self._rate_limiters:
+                self._rate_limiters[endpoint] = RateLimiter(
+                    self.max_requests_per_second
+                )
+            return self._rate_limiters[endpoint]
+
+    @contextmanager
+    def request(
+        self,
+        endpoint: str,
+        sparql_query: str,
+        stream: bool = False,
+        accept: str | None = None,
+        time_budget: float | None = None
+    ) -> Iterator[requests.Response]:
+        # the endpoint slot is held until the response is closed,
+        # such that streamed responses count as running; with a
+        # time budget, waiting for a slot counts against it
+        deadline = None
+        if time_budget is not None:
+            deadline = time.perf_counter() + time_budget
+        with self._semaphore(endpoint):
+            rate_limiter = self._rate_limiter(endpoint)
+            if rate_limiter is not None:
+                rate_limiter.acquire()
+            session = self.session
+            timeout = self.timeout
+            if deadline is not None:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    raise TimeoutError("time budget exceeded before request")
+                session = self._budget_session
+                timeout = (
+                    min(timeout[0], remaining),
+                    min(timeout[1], remaining)
+                )
+            response = session.get(
+                endpoint,
+                params={"query": sparql_query},
+                headers={"Accept": accept} if accept is not None else None,
+                timeout=timeout,
+                stream=stream
+            )
+            try:
+                yield response
+            finally:
+                response.close()
+
+    def close(self):
+        self.session.close()
+        self._budget_session.close()
+
+
+_QLEVER_CLIENT = QLeverClient()
+
+
+def set_qlever_client(client: QLeverClient):
+    # the replaced client is closed, such that its pooled
+    # connections are released
+    global _QLEVER_CLIENT
+    previous = _QLEVER_CLIENT
+    _QLEVER_CLIENT = client
+    if previous is not client:
+        previous.close()
+
+
+def get_qlever_client() -> QLeverClient:
+    return _QLEVER_CLIENT
+
+
+_WHITESPACE_REGEX = re.compile(r"\s*")
+_VARS_REGEX = re.compile(r'"vars"\s*:\s*')
+_BINDINGS_REGEX = re.compile(r'"bindings"\s*:\s*\[')
+
+
+def parse_sparql_json_stream(
+    chunks: Iterator[str]
+) -> tuple[list[str], Iterator[dict[str, Any]]]:
+    # incrementally parses a sparql json result, only the variables
+    # are parsed upfront, bindings are decoded one by one while
+    # iterating, such that the full response is never held in memory
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buf = ""
+    pos = 0
+
+    def _read() -> bool:
+        nonlocal buf, pos
+        chunk = next(chunks, None)
+        if chunk is None:
+            return False
+        buf = buf[pos:] + chunk
+        pos = 0
+        return True
+
+    def _seek(pattern: re.Pattern):
+        nonlocal pos
+        while True:
+            match = pattern.search(buf, pos)
+            if match is not None:
+                pos = match.end()
+                return
+            if not _read():
+                raise ValueError(
+                    f"invalid sparql json, {pattern.pattern} not found"
+                )
+
+    def _peek() -> str:
+        nonlocal pos
+        while True:
+            pos = _WHITESPACE_REGEX.match(buf, pos).end()  # type: ignore
+            if pos < len(buf):
+                return buf[pos]
+            if not _read():
+                raise ValueError("unexpected end of sparql json")
+
+    def _decode() -> Any:
+        nonlocal pos
+        _peek()
+        while True:
+            try:
+                obj, pos = decoder.raw_decode(buf, pos)
+                return obj
+            except json.JSONDecodeError:
+                # incomplete value, read more
+                if not _read():
+                    raise
+
+    _seek(_VARS_REGEX)
+    vars = _decode()
+
+    def _bindings() -> Iterator[dict[str, Any]]:
+        nonlocal pos
+        _seek(_BINDINGS_REGEX)
+        while True:
+            char = _peek()
+            if char == "]":
+                return
+            elif char == ",":
+                pos += 1
+                continue
+            yield _decode()
+
+    return vars, _bindings()
+
+
+_TSV_ESCAPE_REGEX = re.compile(r"\\(.)")
+_TSV_ESCAPES = {"t": "\t", "n": "\n", "r": "\r"}
+
+
+def _parse_tsv_term(term: str) -> Tuple[str, str] | None:
+    # rdf terms as written by qlever, e.g. <iri>, "literal"@en,
+    # "1"^^<datatype>, plain numbers or _:blank nodes
+    if len(term) == 0:
+        return None
+    first = term[0]
+    if first == "<":
+        return term[1:-1], "uri"
+    elif first == "\"":
+        value = term[1:term.rfind("\"")]
+        if "\\" in value:
+            value = _TSV_ESCAPE_REGEX.sub(
+                lambda match: _TSV_ESCAPES.get(match.group(1), match.group(1)),
+                value
+            )
+        return value, "literal"
+    elif term.startswith("_:"):
+        return term[2:], "bnode"
+    return term, "literal"
+
+
+def parse_sparql_tsv_stream(
+    chunks: Iterator[str]
+) -> tuple[list[str], Iterator[List[Tuple[str, str] | None]]]:
+    # parses a sparql tsv result line by line, the header with
+    # the variables is parsed upfront, rows while iterating
+    def _lines() -> Iterator[str]:
+        buf = ""
+        for chunk in chunks:
+            buf += chunk
+            # no str.splitlines, values may contain other line breaks
+            *lines, buf = buf.split("\n")
+            yield from lines
+        # the final line break does not start another row
+        if buf:
+            yield buf
+
+    lines = _lines()
+    header = next(lines, None)
+    if header is None:
+        raise ValueError("invalid sparql tsv, missing header")
+    vars = [
+        var[1:] if var.startswith("?") else var
+        for var in header.rstrip("\r").split("\t")
+    ]
+
+    def _rows() -> Iterator[List[Tuple[str, str] | None]]:
+        for line in lines:
+            line = line.rstrip("\r")
+            if len(line) == 0:
+                # a row with all variables unbound
+                yield [None] * len(vars)
+                continue
+            yield [_parse_tsv_term(term) for term in line.split("\t")]
+
+    return vars, _rows()
+
+
+def _with_deadline(
+    items: Iterator[Any],
+    deadline: float,
+    check_every: int = 1024
+) -> Iterator[Any]:
+    for i, item in enumerate(items):
+        if i % check_every == 0 and time.perf_counter() > deadline:
+            raise TimeoutError("time budget exceeded while reading results")
+        yield item
+
+
+QLEVER_FORMATS = {
+    "json": "application/sparql-results+json",
+    "tsv": "text/tab-separated-values"
+}
+
+
+@contextmanager
+def _qlever_bindings(
+    sparql_query: str,
+    kg: str,
+    qlever_endpoint: str | None,
+    client: QLeverClient | None,
+    stream: bool,
+    max_rows: int | None,
+    result_format: str,
+    time_budget: float | None
+) -> Iterator[tuple[list[str], Iterator[Any]]]:
+    # yields the variables and an iterator over the result rows,
+    # which is only valid while the response is open
+    assert result_format in QLEVER_FORMATS
+    deadline = None
+    if time_budget is not None:
+        deadline = time.perf_counter() + time_budget
+    if qlever_endpoint is None:
+        qlever_endpoint = QLEVER_URLS[kg]
+    if client is None:
+        client = _QLEVER_CLIENT
+    with client.request(
+        qlever_endpoint,
+        sparql_query,
+        stream,
+        QLEVER_FORMATS[result_format],
+        time_budget
+    ) as response:
+        if response.status_code != 200:
+            try:
+                msg = response.json().get("exception", "unknown exception")
+            except ValueError:
+                msg = response.text or "unknown exception"
+            raise RuntimeError(
+                f"query {sparql_query} returned with "
+                f"status code {response.status_code}:\n{msg}"
+            )
+        # sparql results are utf8 encoded unless stated otherwise,
+        # requests would fall back to latin1 for text content types
+        if "charset" not in response.headers.get("Content-Type", ""):
+            response.encoding = "utf8"
+        if not stream and result_format == "json":
+            # the body is decoded once, either way it is fully in memory
+            result_json = json.loads(response.text)
+            vars = result_json["head"]["vars"]
+            bindings = result_json["results"]["bindings"]
+        else:
+            if stream:
+                chunks = response.iter_content(
+                    2 ** 16,
+                    decode_unicode=True
+                )
+            else:
+                chunks = iter([response.text])
+            if result_format == "tsv":
+                vars, bindings = parse_sparql_tsv_stream(chunks)
+            else:
+                vars, bindings = parse_sparql_json_stream(chunks)
+        if max_rows is not None:
+            # stop reading the response once max rows are reached
+            bindings = itertools.islice(bindings, max_rows)
+        if deadline is not None:
+            bindings = _with_deadline(bindings, deadline)
+        yield vars, bindings
+
+
 def query_qlever(
     sparql_query: str,
     kg: str = "wikidata",
-    qlever_endpoint: str | None = None
+    qlever_endpoint: str | None = None,
+    canonicalize: bool = False,
+    client: QLeverClient | None = None,
+    stream: bool = False,
+    max_rows: int | None = None,
+    result_format: str = "json",
+    time_budget: float | None = None
 ) -> SPARQLResult:
-    if qlever_endpoint is None:
-        qlever_endpoint = QLEVER_URLS[kg]
-    response = requests.get(
+    # tsv results are faster to parse, but lose literal
+    # datatypes and languages, use it if only values are needed
+    renamed = {}
+    if canonicalize:
+        # send the canonical query, such that caches in front of qlever
+        # are hit, but keep the original variable names in the result
+        renamed = {
+            name: var
+            for var, name in _canonical_var_mapping(sparql_query).items()
+        }
+        sparql_query = canonicalize_sparql(sparql_query)
+    with _qlever_bindings(
+        sparql_query,
+        kg,
         qlever_endpoint,
-        params={"query": sparql_query}
-    )
-    json = response.json()
-    if response.status_code != 200:
-        msg = json.get("exception", "unknown exception")
-        raise RuntimeError(
-            f"query {sparql_query} returned with "
-            f"status code {response.status_code}:\n{msg}"
-        )
-    vars = json["head"]["vars"]
-    results = []
-    for binding in json["results"]["bindings"]:
-        result = {}
-        for var in vars:
-            if var not in binding:
-                continue
-            value = binding[var]
-            result[var] = SPARQLRecord(
-                value["value"],
-                value["type"]
+        client,
+        stream,
+        max_rows,
+        result_format,
+        time_budget
+    ) as (vars, bindings):
+        names = [
+            re.sub(
+                r"^_v\d+",
+                lambda match: renamed.get(match.group(0), match.group(0)),
+                var
             )
-        results.append(result)
-    return SPARQLResult(vars, results)
+            for var in vars
+        ]
+        if result_format == "tsv":
+            return SPARQLResult.from_rows(names, bindings)
+        return SPARQLResult.from_bindings(vars, bindings, names)
 
 
 PREFIX_REGEX = re.compile(
@@ -587,7 +1114,8 @@ def add_labels(
     sparql: str,
     lang: str = "en",
     kg: str = "wikidata",
-    qlever_endpoint: str | None = None
+    qlever_endpoint: str | None = None,
+    client: QLeverClient | None = None
 ):
     if kg == "wikidata":
         ent_url = "http://www.wikidata.org/entity/"
@@ -607,8 +1135,8 @@ def add_labels(
             var
             for var in result.vars
             if (
-                var in result.results[0]
-                and ent_re.match(result.results[0][var].value) is not None
+                (value := result.column(var)[0]) is not None
+                and ent_re.match(value) is not None
             )
         ]
     else:
@@ -636,12 +1164,16 @@ def add_labels(
         f"SELECT {label_var_str} WHERE {{ " \
         f"{{ {sub_sparql} }} {label_filter} }} "
 
-    label_result = query_qlever(query, kg, qlever_endpoint)
-    for i, record in enumerate(label_result.results):
-        for var, l_var in zip(vars, label_vars):
-            if l_var not in record:
-                continue
-            result.results[i][var].label = record[l_var].value
+    label_result = query_qlever(
+        query,
+        kg,
+        qlever_endpoint,
+        client=client,
+        result_format="tsv"
+    )
+    for var, l_var in zip(vars, label_vars):
+        if l_var in label_result.values:
+            result.set_labels(var, label_result.column(l_var))
 
 
 def format_qlever_result(
@@ -655,7 +1187,7 @@ def format_qlever_result(
         return "no bindings"
 
     data = []
-    for record in result.results:
+    for record in result.rows():
         data.append([
             str(record[var]) if var in record else "-"
             for var in result.vars
@@ -743,24 +1275,311 @@ def format_input(
     )
 
 
+class RowFingerprints:
+    # sorted, unique 64 bit fingerprints of the rows of a query result,
+    # a compact replacement for sets of value tuples when computing f1;
+    # truncated is set if the result had more rows than were read
+    __slots__ = ("values", "truncated")
+
+    def __init__(self, values: np.ndarray, truncated: bool = False):
+        self.values = values
+        self.truncated = truncated
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+def _row_fingerprint(row: List[Tuple[str, str] | None]) -> int:
+    # unbound values hash like empty strings, same as in
+    # SPARQLResult.tuples
+    key = "\x1f".join("" if term is None else term[0] for term in row)
+    digest = hashlib.blake2b(key.encode("utf8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def fingerprint_rows(
+    rows: Iterable[List[Tuple[str, str] | None]],
+    chunk_size: int = 2 ** 16
+) -> np.ndarray:
+    # hashes rows chunk by chunk, such that only the fingerprints
+    # and never all rows are kept in memory
+    rows = iter(rows)
+    chunks = []
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if len(chunk) == 0:
+            break
+        chunks.append(np.unique(np.fromiter(
+            (_row_fingerprint(row) for row in chunk),
+            dtype=np.uint64,
+            count=len(chunk)
+        )))
+    if len(chunks) == 0:
+        return np.empty(0, dtype=np.uint64)
+    return np.unique(np.concatenate(chunks))
+
+
+class QueryResultCache:
+    # persistent, content addressed cache for query results in a sqlite
+    # database, keyed by the canonical query, kg and endpoint; safe to
+    # use from multiple threads and processes
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results "
+            "(key TEXT PRIMARY KEY, kg TEXT, endpoint TEXT, result TEXT)"
+        )
+        # max rows of -1 means no limit
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints "
+            "(key TEXT, max_rows INTEGER, kg TEXT, endpoint TEXT, "
+            "fingerprints BLOB, truncated INTEGER, "
+            "PRIMARY KEY (key, max_rows))"
+        )
+        self._db.commit()
+
+    @staticmethod
+    def key(sparql: str, kg: str, qlever_endpoint: str | None) -> str:
+        h = hashlib.sha256(
+            f"{kg}\n{qlever_endpoint or ''}\n".encode("utf8")
+        )
+        h.update(canonicalize_sparql(sparql).encode("utf8"))
+        return h.hexdigest()
+
+    def get(
+        self,
+        sparql: str,
+        kg: str = "wikidata",
+        qlever_endpoint: str | None = None
+    ) -> Set[Tuple[str, ...]] | None:
+        key = self.key(sparql, kg, qlever_endpoint)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT result FROM results WHERE key = ?",
+                (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return set(tuple(values) for values in json.loads(row[0]))
+
+    def put(
+        self,
+        sparql: str,
+        result: Set[Tuple[str, ...]],
+        kg: str = "wikidata",
+        qlever_endpoint: str | None = None
+    ):
+        key = self.key(sparql, kg, qlever_endpoint)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                (key, kg, qlever_endpoint or "", json.dumps(list(result)))
+            )
+            self._db.commit()
+
+    def get_fingerprints(
+        self,
+        sparql: str,
+        kg: str = "wikidata",
+        qlever_endpoint: str | None = None,
+        max_rows: int | None = None
+    ) -> RowFingerprints | None:
+        key = self.key(sparql, kg, qlever_endpoint)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT fingerprints, truncated FROM fingerprints "
+                "WHERE key = ? AND max_rows = ?",
+                (key, -1 if max_rows is None else max_rows)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return RowFingerprints(
+            np.frombuffer(row[0], dtype="<u8").astype(np.uint64),
+            bool(row[1])
+        )
+
+    def put_fingerprints(
+        self,
+        sparql: str,
+        fingerprints: RowFingerprints,
+        kg: str = "wikidata",
+        qlever_endpoint: str | None = None,
+        max_rows: int | None = None
+    ):
+        key = self.key(sparql, kg, qlever_endpoint)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO fingerprints "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    -1 if max_rows is None else max_rows,
+                    kg,
+                    qlever_endpoint or "",
+                    fingerprints.values.astype("<u8").tobytes(),
+                    int(fingerprints.truncated)
+                )
+            )
+            self._db.commit()
+
+    def invalidate(
+        self,
+        kg: str | None = None,
+        qlever_endpoint: str | None = None
+    ) -> int:
+        # removes all results, or only those for a kg and endpoint
+        where = ""
+        params: tuple = ()
+        if kg is not None:
+            where = " WHERE kg = ? AND endpoint = ?"
+            params = (kg, qlever_endpoint or "")
+        deleted = 0
+        with self._lock:
+            for table in ["results", "fingerprints"]:
+                deleted += self._db.execute(
+                    f"DELETE FROM {table}{where}",
+                    params
+                ).rowcount
+            self._db.commit()
+        return deleted
+
+    def close(self):
+        self._db.close()
+
+
 def query_entities(
     sparql: str,
     kg: str = "wikidata",
-    qlever_endpoint: str | None = None
+    qlever_endpoint: str | None = None,
+    client: QLeverClient | None = None,
+    cache: QueryResultCache | None = None
 ) -> Optional[Set[Tuple[str, ...]]]:
+    # failed queries are not cached, they might succeed on retry
+    if cache is not None:
+        cached = cache.get(sparql, kg, qlever_endpoint)
+        if cached is not None:
+            return cached
     try:
-        result = query_qlever(sparql, kg, qlever_endpoint)
-        if len(result) == 0:
-            return set()
-        return set(
-            tuple(
-                r[var].value if var in r else ""
-                for var in result.vars
-            )
-            for r in result.results
+        result = query_qlever(
+            sparql,
+            kg,
+            qlever_endpoint,
+            client=client,
+            stream=True,
+            result_format="tsv"
         )
+        entities = set(result.tuples())
     except Exception:
         return None
+    if cache is not None:
+        cache.put(sparql, entities, kg, qlever_endpoint)
+    return entities
+
+
+def query_fingerprints(
+    sparql: str,
+    kg: str = "wikidata",
+    qlever_endpoint: str | None = None,
+    client: QLeverClient | None = None,
+    cache: QueryResultCache | None = None,
+    max_rows: int | None = None
+) -> Optional[RowFingerprints]:
+    # like query_entities, but hashes rows while streaming them, such
+    # that results with millions of rows fit into memory; at most
+    # max_rows rows are read, larger results are marked as truncated
+    if cache is not None:
+        cached = cache.get_fingerprints(sparql, kg, qlever_endpoint, max_rows)
+        if cached is not None:
+            return cached
+    try:
+        with _qlever_bindings(
+            sparql,
+            kg,
+            qlever_endpoint,
+            client,
+            stream=True,
+            max_rows=None if max_rows is None else max_rows + 1,
+            result_format="tsv",
+            time_budget=None
+        ) as (_, bindings):
+            if max_rows is None:
+                fingerprints = RowFingerprints(fingerprint_rows(bindings))
+            else:
+                values = fingerprint_rows(
+                    itertools.islice(bindings, max_rows)
+                )
+                truncated = next(bindings, None) is not None
+                fingerprints = RowFingerprints(values, truncated)
+    except Exception:
+        return None
+    if cache is not None:
+        cache.put_fingerprints(
+            sparql,
+            fingerprints,
+            kg,
+            qlever_endpoint,
+            max_rows
+        )
+    return fingerprints
+
+
+def query_entities_iter(
+    queries: Iterable[Tuple[str, bool]],
+    kg: str = "wikidata",
+    qlever_endpoint: str | None = None,
+    client: QLeverClient | None = None,
+    cache: QueryResultCache | None = None,
+    max_workers: int = 16,
+    fingerprints: bool = False,
+    max_rows: int | None = None,
+    timed: bool = False
+) -> Iterator[Any]:
+    # executes (query, use cache) pairs concurrently in threads
+    # and yields their results in input order, either as sets
+    # or as row fingerprints; if timed, (result, seconds) pairs
+    # are yielded instead
+    assert fingerprints or max_rows is None, \
+        "max rows is only supported for fingerprints"
+
+    def _query(
+        item: Tuple[str, bool]
+    ) -> Optional[Set[Tuple[str, ...]] | RowFingerprints]:
+        sparql, use_cache = item
+        if fingerprints:
+            return query_fingerprints(
+                sparql,
+                kg,
+                qlever_endpoint,
+                client,
+                cache if use_cache else None,
+                max_rows
+            )
+        return query_entities(
+            sparql,
+            kg,
+            qlever_endpoint,
+            client,
+            cache if use_cache else None
+        )
+
+    def _timed(
+        item: Tuple[str, bool]
+    ) -> Tuple[Optional[Set[Tuple[str, ...]] | RowFingerprints], float]:
+        start = time.perf_counter()
+        result = _query(item)
+        return result, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        yield from executor.map(_timed if timed else _query, queries)
 
 
 def calc_f1(
@@ -768,10 +1587,28 @@ def calc_f1(
     target: str,
     allow_empty_target: bool = True,
     kg: str = "wikidata",
-    qlever_endpoint: str | None = None
+    qlever_endpoint: str | None = None,
+    client: QLeverClient | None = None,
+    target_cache: QueryResultCache | None = None
 ) -> Tuple[Optional[float], bool, bool]:
-    pred_set = query_entities(pred, kg, qlever_endpoint)
-    target_set = query_entities(target, kg, qlever_endpoint)
+    # only targets are cached, they do not change between evaluations
+    pred_set = query_entities(pred, kg, qlever_endpoint, client)
+    target_set = query_entities(
+        target,
+        kg,
+        qlever_endpoint,
+        client,
+        target_cache
+    )
+    return calc_f1_from_sets(pred_set, target_set, allow_empty_target)
+
+
+def calc_f1_from_sets(
+    pred_set: Optional[Set[Tuple[str, ...]]],
+    target_set: Optional[Set[Tuple[str, ...]]],
+    allow_empty_target: bool = True
+) -> Tuple[Optional[float], bool, bool]:
+    # None sets are from invalid queries
     if pred_set is None or target_set is None:
         return None, pred_set is None, target_set is None
     if len(target_set) == 0 and not allow_empty_target:
@@ -779,16 +1616,276 @@ def calc_f1(
     if len(pred_set) == 0 and len(target_set) == 0:
         return 1.0, False, False
     tp = len(pred_set.intersection(target_set))
-    fp = len(pred_set.difference(target_set))
-    fn = len(target_set.difference(pred_set))
+    return _f1(tp, len(pred_set), len(target_set)), False, False
+
+
+def calc_f1_from_fingerprints(
+    pred: Optional[RowFingerprints],
+    target: Optional[RowFingerprints],
+    allow_empty_target: bool = True
+) -> Tuple[Optional[float], bool, bool]:
+    # same as calc_f1_from_sets, but intersects the sorted
+    # fingerprint arrays instead of sets of tuples
+    if pred is None or target is None:
+        return None, pred is None, target is None
+    if len(target) == 0 and not allow_empty_target:
+        return None, False, True
+    if len(pred) == 0 and len(target) == 0:
+        return 1.0, False, False
+    tp = len(np.intersect1d(
+        pred.values,
+        target.values,
+        assume_unique=True
+    ))
+    return _f1(tp, len(pred), len(target)), False, False
+
+
+def _f1(tp: int, num_pred: int, num_target: int) -> float:
     # calculate precision, recall and f1
-    if tp > 0:
-        p = tp / (tp + fp)
-        r = tp / (tp + fn)
-        f1 = 2 * p * r / (p + r)
-    else:
-        f1 = 0.0
-    return f1, False, False
+    if tp == 0:
+        return 0.0
+    p = tp / num_pred
+    r = tp / num_target
+    return 2 * p * r / (p + r)
+
+
+UUID_VAR_REGEX = re.compile(
+    r"\?([0-9a-f]{8}_[0-9a-f]{4}_[0-9a-f]{4}_[0-9a-f]{4}_[0-9a-f]{12})"
+)
+# string literals (long and short, with escapes) and iris, which
+# must be kept as they are when canonicalizing queries
+_QUOTED_REGEX = re.compile(
+    r'"""(?:[^"\\]|\\.|"(?!""))*"""'
+    r"|'''(?:[^'\\]|\\.|'(?!''))*'''"
+    r'|"(?:[^"\\\n]|\\.)*"'
+    r"|'(?:[^'\\\n]|\\.)*'"
+    r'|<[^<>"{}|^`\\\s]*>',
+    flags=re.DOTALL
+)
+
+
+def _unquoted_segments(sparql: str) -> Iterator[Tuple[str, bool]]:
+    # splits the query into (segment, is quoted) pairs
+    start = 0
+    for match in _QUOTED_REGEX.finditer(sparql):
+        yield sparql[start:match.start()], False
+        yield match.group(0), True
+        start = match.end()
+    yield sparql[start:], False
+
+
+def _canonical_var_names(used: Set[str]) -> Iterator[str]:
+    # variable names that do not clash with the used ones
+    i = 0
+    while True:
+        name = f"_v{i}"
+        i += 1
+        if name not in used:
+            yield name
+
+
+def _canonical_var_mapping(sparql: str) -> Dict[str, str]:
+    # maps the random variables in the query (see _get_unique_var_name)
+    # to canonical names in order of appearance
+    used = set(
+        var for var in VAR_REGEX.findall(sparql)
+        if UUID_VAR_REGEX.match(f"?{var}") is None
+    )
+    names = _canonical_var_names(used)
+    mapping: Dict[str, str] = {}
+    for segment, quoted in _unquoted_segments(sparql):
+        if quoted:
+            continue
+        for match in UUID_VAR_REGEX.finditer(segment):
+            if match.group(1) not in mapping:
+                mapping[match.group(1)] = next(names)
+    return mapping
+
+
+def canonicalize_sparql(sparql: str) -> str:
+    # renames random variables and normalizes whitespace outside of
+    # literals and iris, such that structurally identical queries
+    # are equal
+    mapping = _canonical_var_mapping(sparql)
+    segments = []
+    for segment, quoted in _unquoted_segments(sparql):
+        if not quoted:
+            segment = UUID_VAR_REGEX.sub(
+                lambda match: f"?{mapping[match.group(1)]}",
+                segment
+            )
+            segment = re.sub(r"\s+", " ", segment)
+        segments.append(segment)
+    return "".join(segments).strip()
+
+
+class CompletionCache:
+    # thread safe lru cache for completion results, optionally backed
+    # by a sqlite database on disk such that results are reused
+    # across runs; in memory, it is bounded by the number of entries
+    # and the total number of completion values in them; entries
+    # older than ttl seconds are ignored
+    def __init__(
+        self,
+        max_size: int = 4096,
+        ttl: float | None = None,
+        path: str | None = None,
+        max_disk_size: int | None = None,
+        max_values: int = 2 ** 20
+    ):
+        self.max_size = max_size
+        self.max_values = max_values
+        self.num_values = 0
+        self.ttl = ttl
+        self.path = path
+        self.max_disk_size = max_disk_size
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[
+            str,
+            tuple[float, list[str] | None]
+        ] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._disk_size = 0
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS completions "
+                "(key TEXT PRIMARY KEY, value TEXT, created REAL)"
+            )
+            self._db.commit()
+            self._disk_size = self._db.execute(
+                "SELECT COUNT(*) FROM completions"
+            ).fetchone()[0]
+
+    @staticmethod
+    def key(sparql: str, kg: str, qlever_endpoint: str | None = None) -> str:
+        h = hashlib.sha256(
+            f"{kg}\n{qlever_endpoint or ''}\n".encode("utf8")
+        )
+        h.update(canonicalize_sparql(sparql).encode("utf8"))
+        return h.hexdigest()
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key: str) -> tuple[bool, list[str] | None]:
+        # returns whether the key was found and its completions,
+        # completions are None if there were too many of them
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._expired(entry[0]):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+
+            row = None
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created FROM completions WHERE key = ?",
+                    (key,)
+                ).fetchone()
+            if row is None or self._expired(row[1]):
+                self.misses += 1
+                return False, None
+
+            value = None if row[0] is None else json.loads(row[0])
+            self._put_memory(key, row[1], value)
+            self.disk_hits += 1
+            return True, value
+
+    @staticmethod
+    def _num_values(value: list[str] | None) -> int:
+        return 0 if value is None else len(value)
+
+    def _put_memory(
+        self,
+        key: str,
+        created: float,
+        value: list[str] | None
+    ):
+        size = self._num_values(value)
+        if self.max_size <= 0 or size > self.max_values:
+            return
+        if key in self._entries:
+            self.num_values -= self._num_values(self._entries.pop(key)[1])
+        self._entries[key] = (created, value)
+        self.num_values += size
+        while (
+            len(self._entries) > self.max_size
+            or self.num_values > self.max_values
+        ):
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.num_values -= self._num_values(evicted)
+
+    def put(self, key: str, value: list[str] | None):
+        created = time.time()
+        with self._lock:
+            self._put_memory(key, created, value)
+            if self._db is None:
+                return
+            exists = self._db.execute(
+                "SELECT 1 FROM completions WHERE key = ?",
+                (key,)
+            ).fetchone() is not None
+            self._db.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?)",
+                (key, None if value is None else json.dumps(value), created)
+            )
+            self._disk_size += not exists
+            if (
+                self.max_disk_size is not None
+                and self._disk_size > self.max_disk_size
+            ):
+                # drop the oldest entries
+                self._db.execute(
+                    "DELETE FROM completions WHERE key IN "
+                    "(SELECT key FROM completions ORDER BY created LIMIT ?)",
+                    (self._disk_size - self.max_disk_size,)
+                )
+                self._disk_size = self.max_disk_size
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.num_values = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM completions")
+                self._db.commit()
+                self._disk_size = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.disk_hits + self.misses
+        return (self.hits + self.disk_hits) / total if total > 0 else 0.0
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "num_values": self.num_values,
+            "max_values": self.max_values,
+            "disk_size": self._disk_size,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate
+        }
+
+
+_COMPLETION_CACHE: CompletionCache | None = CompletionCache()
+
+
+def set_completion_cache(cache: CompletionCache | None):
+    global _COMPLETION_CACHE
+    _COMPLETION_CACHE = cache
+
+
+def get_completion_cache() -> CompletionCache | None:
+    return _COMPLETION_CACHE
 
 
 def _get_unique_var_name() -> str:
@@ -798,25 +1895,38 @@ def _get_unique_var_name() -> str:
 def _autocomplete_sparql(
     sparql: str,
     current_state: str,
-    additional_constraints: Callable[[str], str] | None = None
+    additional_constraints: Callable[
+        [str, Callable[[], str]],
+        str
+    ] | None = None,
+    canonical: bool = False
 ) -> tuple[str, str] | None:
     open, close = _count_open_and_closing_brackets(sparql)
     if close >= open:
         return None
+    if canonical:
+        # stable variable names that are not yet used in the query
+        names = _canonical_var_names(set(VAR_REGEX.findall(sparql)))
+
+        def _var_name() -> str:
+            return next(names)
+    else:
+        _var_name = _get_unique_var_name
+
     # generate unique variable name
-    var = _get_unique_var_name()
+    var = _var_name()
     sparql += f" ?{var}"
     if current_state == "subject":
-        pred_var = _get_unique_var_name()
-        obj_var = _get_unique_var_name()
+        pred_var = _var_name()
+        obj_var = _var_name()
         sparql += f" ?{pred_var} ?{obj_var} ."
     elif current_state == "predicate":
-        obj_var = _get_unique_var_name()
+        obj_var = _var_name()
         sparql += f" ?{obj_var} ."
     else:
         sparql += " ."
     if additional_constraints is not None:
-        sparql += additional_constraints(var)
+        sparql += additional_constraints(var, _var_name)
     sparql += "".join(" }" * (open - close))
     return sparql, var
 
@@ -828,13 +1938,19 @@ def get_completions(
     property_index: prefix.Vec,
     kg: str = "wikidata",
     lang: str = "en",
-    max_size: int = 8192
+    max_size: int = 8192,
+    canonical: bool = True,
+    client: QLeverClient | None = None,
+    time_budget: float | None = None
 ) -> list[str] | None:
     assert current_state in {"subject", "predicate", "object"}
     additional_constraints = None
     if kg == "wikidata" and current_state == "predicate":
-        def _wikidata_predicate_constraints(var: str) -> str:
-            prop_var = _get_unique_var_name()
+        def _wikidata_predicate_constraints(
+            var: str,
+            var_name: Callable[[], str]
+        ) -> str:
+            prop_var = var_name()
             return f"?{prop_var} wikibase:directClaim ?{var} . " \
                 f"?{prop_var} rdfs:label ?{prop_var}_label . "\
                 f"FILTER(LANG(?{prop_var}_label) = '{lang}')"
@@ -843,7 +1959,8 @@ def get_completions(
     completion = _autocomplete_sparql(
         sparql,
         current_state,
-        additional_constraints
+        additional_constraints,
+        canonical
     )
     if completion is None:
         return None
@@ -867,12 +1984,34 @@ def get_completions(
         flags=re.IGNORECASE,
         count=1
     )
+    if canonical:
+        # also rename variables introduced when transforming ask queries
+        sparql = canonicalize_sparql(sparql)
+    cache = _COMPLETION_CACHE
+    if cache is not None:
+        key = cache.key(sparql, kg)
+        found, values = cache.get(key)
+        if found:
+            return values
+
     try:
-        result = query_qlever(sparql, kg)
+        result = query_qlever(
+            sparql,
+            kg,
+            client=client,
+            stream=True,
+            max_rows=max_size + 1,
+            result_format="tsv",
+            time_budget=time_budget
+        )
     except Exception:
+        # also when the time budget is exceeded, in which case
+        # the result is not cached and the query is retried later
         return None
 
-    if len(result.results) > max_size:
+    if len(result) > max_size:
+        if cache is not None:
+            cache.put(key, None)
         return None
 
     if kg == "wikidata":
@@ -886,14 +2025,15 @@ def get_completions(
 
         pattern = re.compile(pattern)
 
-        for res in result.results:
-            rec = res.get(var)
-            if rec is None:
+        for uri in result.values.get(var, []):
+            if uri is None:
                 continue
-            value = next(pattern.finditer(rec.value), None)
+            value = next(pattern.finditer(uri), None)
             if value is None:
                 continue
             results.append(prefix + value.group(1))
     else:
         raise NotImplementedError
+    if cache is not None:
+        cache.put(key, results)
     return results